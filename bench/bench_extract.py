@@ -0,0 +1,54 @@
+"""Микробенчмарк: быстрый экстрактор initial-state против полного разбора BeautifulSoup
+и разбор ответа JSON API Boosty.
+
+Запуск:
+    python bench/bench_extract.py [страница.html ...]
+
+Без аргументов используется синтетическая страница, похожая по размеру на страницу канала Boosty.
+"""
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TG_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_URL", "")
+
+from bs4 import BeautifulSoup  # noqa: E402
+from bot import CATCHUP_MAX_POSTS, extract_initial_state, latest_with_recent, parse_last_post  # noqa: E402
+from synthetic import synthetic_api_response, synthetic_page  # noqa: E402
+
+
+def soup_extract(html):
+    tag = BeautifulSoup(html, "html.parser").find("script", {"id": "initial-state"})
+    return tag.text if tag else None
+
+
+def timeit(fn, html, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(html)
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    pages = [(path, open(path, encoding="utf-8").read()) for path in sys.argv[1:]]
+    if not pages:
+        pages = [("synthetic", synthetic_page())]
+
+    for name, html in pages:
+        assert extract_initial_state(html) == soup_extract(html), f"{name}: результаты экстракторов различаются"
+        fast = timeit(extract_initial_state, html, 200)
+        full = timeit(soup_extract, html, 10)
+        parse = timeit(lambda h: parse_last_post(h, "bench"), html, 200)
+        print(f"{name}: {len(html) / 1024:.0f} КБ | extract {fast:.3f} мс | "
+              f"BeautifulSoup {full:.1f} мс | parse_last_post {parse:.3f} мс | x{full / fast:.0f}")
+
+    payload = synthetic_api_response(limit=CATCHUP_MAX_POSTS)
+    api = timeit(lambda p: latest_with_recent(json.loads(p)["data"], "bench"), payload, 200)
+    print(f"API limit={CATCHUP_MAX_POSTS}: {len(payload) / 1024:.0f} КБ | разбор {api:.3f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Нагрузочная симуляция конвейера опроса без сети.
+
+Поднимает заглушки Boosty и Telegram Bot API (bench/stubs.py), заполняет Redis
+подписками, прогоняет планировщик до исчерпания просроченных каналов, доставку
+уведомлений и обработчики команд, после чего печатает время цикла, число запросов
+к Boosty в секунду, операции Redis и память.
+
+Запуск:
+    pip install -r requirements.txt -r bench/requirements.txt
+    python bench/load_sim.py --users 10000 --channels-per-user 50 --distinct-channels 5000
+
+Без --redis-url используется fakeredis (нужен пакет с поддержкой Lua, см. bench/requirements.txt).
+С --max-cycle-seconds скрипт завершается с кодом 1, если цикл планировщика медленнее порога.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from stubs import BENCH_POST_TS, boosty_stub, telegram_stub, start_stub, stub_stats  # noqa: E402
+
+TG_TOKEN = "123456:bench"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--channels-per-user", type=int, default=50)
+    parser.add_argument("--distinct-channels", type=int, default=2000)
+    parser.add_argument("--commands", type=int, default=50, help="сколько команд /list и /checkall прогнать")
+    parser.add_argument("--deliver-seconds", type=float, default=30, help="сколько секунд отдавать доставке")
+    parser.add_argument("--pages", help="каталог с записанными страницами <канал>.html (API заглушки отключается)")
+    parser.add_argument("--redis-url", help="настоящий Redis вместо fakeredis (база будет очищена)")
+    parser.add_argument("--json", action="store_true", help="вывести отчет в JSON")
+    parser.add_argument("--max-cycle-seconds", type=float, help="порог времени цикла планировщика")
+    return parser.parse_args()
+
+
+def command_update(update_id: int, user_id: str, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": int(user_id), "type": "private"},
+            "from": {"id": int(user_id), "is_bot": False, "first_name": "bench"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def redis_server_commands(client):
+    """Число обработанных сервером команд (fakeredis его может не отдавать)"""
+    try:
+        return (await client.info("stats"))["total_commands_processed"]
+    except Exception:
+        return None
+
+
+def redis_client_ops(bot):
+    """Число замеренных обращений к Redis через db_* функции"""
+    return sum(sample.value for metric in bot.REDIS_SECONDS.collect()
+               for sample in metric.samples if sample.name.endswith("_count"))
+
+
+async def seed(bot, args):
+    """Пользователи с подписками, у которых на заглушке есть более новый пост"""
+    channels = [f"ch{i}" for i in range(args.distinct_channels)]
+    user_ids = [str(100000 + i) for i in range(args.users)]
+    rnd = random.Random(42)
+    per_user = min(args.channels_per_user, len(channels))
+    for uid in user_ids:
+        subs = {ch: {"interval": 6, "last_sent": BENCH_POST_TS - 3600, "last_check": 0}
+                for ch in rnd.sample(channels, per_user)}
+        await bot.db_save_user_subs(uid, subs)
+    await bot.redis_client.set("due_index_shards", bot.SCHEDULER_SHARDS)
+    return user_ids
+
+
+async def run(args, boosty_url, telegram_url):
+    import bot
+
+    if args.redis_url:
+        import redis.asyncio as redis
+        bot.redis_client = redis.from_url(args.redis_url, decode_responses=True)
+        await bot.redis_client.flushdb()
+    else:
+        import fakeredis
+        bot.redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    bot.register_redis_scripts()
+    bot.http_client = bot.create_http_client()
+    bot.telegram_app = bot.build_telegram_app()
+    await bot.telegram_app.initialize()
+    await bot.telegram_app.start()
+    report = {"users": args.users, "channels_per_user": args.channels_per_user,
+              "distinct_channels": args.distinct_channels}
+
+    started = time.perf_counter()
+    user_ids = await seed(bot, args)
+    report["seed_seconds"] = round(time.perf_counter() - started, 2)
+
+    # Планировщик: все шарды у этой реплики, прогоняем до исчерпания просроченных каналов
+    bot.owned_shards.update(range(bot.SCHEDULER_SHARDS))
+    fetches_before = stub_stats(boosty_url)
+    server_ops_before = await redis_server_commands(bot.redis_client)
+    client_ops_before = redis_client_ops(bot)
+    tracemalloc.start()
+    started = time.perf_counter()
+    while await bot.run_scheduler_cycle():
+        pass
+    cycle = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    fetches = stub_stats(boosty_url)
+    server_ops_after = await redis_server_commands(bot.redis_client)
+
+    report["cycle_seconds"] = round(cycle, 2)
+    report["boosty_fetches"] = fetches["requests"] - fetches_before["requests"]
+    report["boosty_mb"] = round((fetches["bytes"] - fetches_before["bytes"]) / 1e6, 1)
+    report["boosty_api_fetches"] = fetches["api_requests"] - fetches_before["api_requests"]
+    report["boosty_api_mb"] = round((fetches["api_bytes"] - fetches_before["api_bytes"]) / 1e6, 1)
+    total_fetches = report["boosty_fetches"] + report["boosty_api_fetches"]
+    report["fetches_per_second"] = round(total_fetches / cycle, 1) if cycle else 0
+    report["redis_client_ops"] = int(redis_client_ops(bot) - client_ops_before)
+    if server_ops_before is not None and server_ops_after is not None:
+        report["redis_server_commands"] = server_ops_after - server_ops_before
+    report["cycle_peak_alloc_mb"] = round(peak / 1e6, 1)
+    report["notifications_enqueued"] = await bot.redis_client.llen("notify_queue")
+
+    # Доставка уведомлений через заглушку Bot API
+    stop_event = asyncio.Event()
+    workers = [asyncio.create_task(bot.delivery_worker(stop_event)) for _ in range(bot.NOTIFY_WORKERS)]
+    sent_before = stub_stats(telegram_url).get("sendMessage", 0)
+    started = time.perf_counter()
+    while time.perf_counter() - started < args.deliver_seconds:
+        if not await bot.redis_client.llen("notify_queue") and not await bot.redis_client.zcard("notify_inflight"):
+            break
+        await asyncio.sleep(0.2)
+    stop_event.set()
+    await asyncio.gather(*workers)
+    elapsed = time.perf_counter() - started
+    sent = stub_stats(telegram_url).get("sendMessage", 0) - sent_before
+    report["notifications_sent"] = sent
+    report["sends_per_second"] = round(sent / elapsed, 1) if elapsed else 0
+
+    # Обработчики команд
+    latencies = {"/list": [], "/checkall": []}
+    rnd = random.Random(7)
+    for i in range(args.commands):
+        text = "/list" if i % 2 else "/checkall"
+        update = bot.Update.de_json(command_update(i + 1, rnd.choice(user_ids), text), bot.telegram_app.bot)
+        started = time.perf_counter()
+        await bot.telegram_app.process_update(update)
+        latencies[text].append(time.perf_counter() - started)
+    for text, values in latencies.items():
+        report[f"{text[1:]}_p50_ms"] = round(percentile(values, 0.5) * 1000, 1)
+        report[f"{text[1:]}_p99_ms"] = round(percentile(values, 0.99) * 1000, 1)
+
+    report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    await bot.telegram_app.stop()
+    await bot.telegram_app.shutdown()
+    await bot.http_client.aclose()
+    await bot.redis_client.close()
+    return report
+
+
+def main():
+    args = parse_args()
+    boosty_proc, boosty_url = start_stub(boosty_stub, pages_dir=args.pages)
+    telegram_proc, telegram_url = start_stub(telegram_stub)
+    try:
+        # Окружение бота задается до импорта модуля: bot читает его при импорте
+        assert "bot" not in sys.modules, "bot импортирован раньше, чем задано окружение заглушек"
+        os.environ.update({
+            "TG_TOKEN": TG_TOKEN,
+            "WEBHOOK_URL": "",
+            "BOOSTY_BASE_URL": f"{boosty_url}/",
+            "BOOSTY_API_URL": f"{boosty_url}/",
+            "TELEGRAM_API_URL": f"{telegram_url}/bot",
+            "POST_CACHE_REDIS": "0",
+        })
+        os.environ.setdefault("NOTIFY_RATE", "1000")
+        os.environ.setdefault("NOTIFY_CHAT_INTERVAL", "0")
+        report = asyncio.run(run(args, boosty_url, telegram_url))
+    finally:
+        boosty_proc.terminate()
+        telegram_proc.terminate()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>24}: {value}")
+
+    if args.max_cycle_seconds and report["cycle_seconds"] > args.max_cycle_seconds:
+        print(f"Цикл планировщика {report['cycle_seconds']} с дольше порога {args.max_cycle_seconds} с")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Локальные заглушки Boosty (страницы и JSON API) и Telegram Bot API для нагрузочных прогонов без сети.
+
+Каждая заглушка запускается в отдельном процессе, чтобы не делить event loop с ботом,
+и отдает счетчики запросов на GET /__stats.
+"""
+import os
+import time
+import socket
+import multiprocessing
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, Response
+
+from synthetic import BENCH_POST_TS, synthetic_api_response, synthetic_page
+
+
+def boosty_stub(pages_dir=None):
+    """Заглушка boosty.to: записанные страницы из pages_dir (<канал>.html) или синтетические.
+    JSON API отвечает синтетическими постами; с записанными страницами API нет (404),
+    чтобы бот проверял их через запасной путь."""
+    app = FastAPI()
+    stats = {"requests": 0, "bytes": 0, "api_requests": 0, "api_bytes": 0}
+    recorded = {}
+    if pages_dir:
+        for name in sorted(os.listdir(pages_dir)):
+            if name.endswith(".html"):
+                with open(os.path.join(pages_dir, name), encoding="utf-8") as f:
+                    recorded[name[:-5]] = f.read()
+    generated = {}
+
+    @app.get("/__stats")
+    async def get_stats():
+        return stats
+
+    @app.get("/v1/blog/{channel}/post/")
+    async def api_posts(channel: str, limit: int = 10):
+        stats["api_requests"] += 1
+        if recorded:
+            return Response(status_code=404)
+        payload = synthetic_api_response(channel, BENCH_POST_TS, limit)
+        stats["api_bytes"] += len(payload)
+        return Response(payload, media_type="application/json")
+
+    @app.get("/{channel}")
+    async def page(channel: str):
+        if recorded:
+            html = recorded.get(channel) or list(recorded.values())[hash(channel) % len(recorded)]
+        else:
+            if channel not in generated:
+                generated[channel] = synthetic_page(channel, BENCH_POST_TS)
+            html = generated[channel]
+        stats["requests"] += 1
+        stats["bytes"] += len(html)
+        return HTMLResponse(html)
+
+    return app
+
+
+def telegram_stub():
+    """Заглушка Bot API: принимает любые методы и отвечает успехом"""
+    app = FastAPI()
+    stats = {}
+
+    @app.get("/__stats")
+    async def get_stats():
+        return stats
+
+    @app.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+    async def call(token: str, method: str, request: Request):
+        stats[method] = stats.get(method, 0) + 1
+        try:
+            params = dict(await request.form())
+        except Exception:
+            params = {}
+        if not params and await request.body():
+            params = await request.json()
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = {"message_id": stats[method], "date": int(time.time()),
+                      "chat": {"id": int(params.get("chat_id", 1)), "type": "private"},
+                      "text": params.get("text", "")}
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(factory, port, kwargs):
+    uvicorn.run(factory(**kwargs), host="127.0.0.1", port=port, log_level="warning")
+
+
+def start_stub(factory, **kwargs):
+    """Запускает заглушку в отдельном процессе, возвращает (процесс, базовый URL)"""
+    port = free_port()
+    process = multiprocessing.Process(target=serve, args=(factory, port, kwargs), daemon=True)
+    process.start()
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(f"{url}/__stats", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"Заглушка {factory.__name__} не запустилась")
+
+
+def stub_stats(url: str) -> dict:
+    return httpx.get(f"{url}/__stats", timeout=5).json()
@@ -0,0 +1,28 @@
+"""Синтетические страницы канала и ответы JSON API Boosty для бенчмарков.
+
+Модуль не импортирует bot: заглушки и load_sim загружают его до того, как
+задано окружение бота.
+"""
+import json
+
+# Время последнего поста на всех синтетических страницах
+BENCH_POST_TS = 1700000000
+
+
+def synthetic_posts(channel="bench", latest_ts=BENCH_POST_TS, posts=20):
+    return [{"id": f"post-{i}", "title": f"Пост {i}", "publishTime": latest_ts - i * 3600,
+             "user": {"blogUrl": channel}, "data": [{"type": "text", "content": "x" * 500}]}
+            for i in range(posts)]
+
+
+def synthetic_api_response(channel="bench", latest_ts=BENCH_POST_TS, limit=10):
+    """Ответ /v1/blog/<канал>/post/?limit=N"""
+    return json.dumps({"data": synthetic_posts(channel, latest_ts, limit), "extra": {"isLast": False}})
+
+
+def synthetic_page(channel="bench", latest_ts=BENCH_POST_TS, posts=20, filler=3000):
+    state = {"posts": {"postsList": {"data": {"posts": synthetic_posts(channel, latest_ts, posts)}}}}
+    body = "".join(f'<div class="c{i}"><span>item {i}</span><a href="/p/{i}">link</a></div>' for i in range(filler))
+    return (f"<html><head><title>{channel}</title></head><body>{body}"
+            f'<script id="initial-state" type="application/json">{json.dumps(state)}</script>'
+            f"<script>window.x = 1;</script></body></html>")
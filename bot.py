@@ -1,16 +1,32 @@
 import os
+import re
 import json
 import time
+import zlib
+import random
+import uuid
+import socket
+import functools
+import secrets
+import hashlib
 import asyncio
-import requests
+import contextvars
+import httpx
 import difflib
 import redis.asyncio as redis
 from bs4 import BeautifulSoup
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
-from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CallbackQueryHandler,
@@ -26,19 +42,274 @@ TG_TOKEN = os.getenv("TG_TOKEN")
 # Ожидается URL без токена в конце, например https://myapp.com
 WEBHOOK_URL = os.getenv("WEBHOOK_URL") + TG_TOKEN
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-BOOSTY_BASE_URL = "https://boosty.to/"
+BOOSTY_BASE_URL = os.getenv("BOOSTY_BASE_URL", "https://boosty.to/")
+# Адрес Bot API (для локальных заглушек), по умолчанию https://api.telegram.org/bot
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Планировщик: период цикла, общий лимит параллельных проверок,
+# лимит одновременных запросов к одному хосту и дедлайн цикла (секунды)
+SCHEDULER_PERIOD = int(os.getenv("SCHEDULER_PERIOD", 300))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", 20))
+HOST_CONCURRENCY = int(os.getenv("HOST_CONCURRENCY", 8))
+# Классы запросов к Boosty по убыванию приоритета и слоты хоста, которые остаются
+# за старшими классами: фоновый опрос не занимает слоты ручных проверок и подписок
+FETCH_LANES = ("interactive", "subscribe", "background")
+FETCH_RESERVED_INTERACTIVE = int(os.getenv("FETCH_RESERVED_INTERACTIVE", 2))
+FETCH_RESERVED_SUBSCRIBE = int(os.getenv("FETCH_RESERVED_SUBSCRIBE", 1))
+SCHEDULER_CYCLE_DEADLINE = int(os.getenv("SCHEDULER_CYCLE_DEADLINE", 270))
+# Каналы делятся на шарды; реплика проверяет только шарды, на которые держит аренду в Redis
+SCHEDULER_SHARDS = int(os.getenv("SCHEDULER_SHARDS", 16))
+SCHEDULER_LEASE_TTL = int(os.getenv("SCHEDULER_LEASE_TTL", 30))
+# Остановка: сколько секунд дать уже начатым проверкам и сколько всего ждать планировщик.
+# Взятый в работу канал недоступен другим репликам SCHEDULER_CLAIM_TTL секунд
+SCHEDULER_STOP_GRACE = float(os.getenv("SCHEDULER_STOP_GRACE", 5))
+SCHEDULER_SHUTDOWN_TIMEOUT = float(os.getenv("SCHEDULER_SHUTDOWN_TIMEOUT", 15))
+SCHEDULER_CLAIM_TTL = int(os.getenv("SCHEDULER_CLAIM_TTL", SCHEDULER_CYCLE_DEADLINE * 2))
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+# Адаптивный опрос: срок проверки канала считается по истории его постов
+# в пределах [interval / ADAPTIVE_RANGE, interval] — реже, чем просил пользователь, не проверяем
+ADAPTIVE_POLLING = os.getenv("ADAPTIVE_POLLING", "0") == "1"
+ADAPTIVE_RANGE = float(os.getenv("ADAPTIVE_RANGE", 4))
+ADAPTIVE_CHECKS_PER_POST = float(os.getenv("ADAPTIVE_CHECKS_PER_POST", 4))
+ADAPTIVE_MIN_POSTS = int(os.getenv("ADAPTIVE_MIN_POSTS", 3))
+ADAPTIVE_HISTORY = int(os.getenv("ADAPTIVE_HISTORY", 50))
+# Сколько просроченных каналов забирать из индекса сроков за один проход
+SCHEDULER_BATCH = int(os.getenv("SCHEDULER_BATCH", 1000))
+
+# HTTP-клиент: размер пула соединений, keep-alive и таймауты (секунды)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 50))
+HTTP_KEEPALIVE = int(os.getenv("HTTP_KEEPALIVE", 20))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+
+# Потоковое чтение страницы канала до конца блока initial-state и лимит байт на страницу.
+# Обрывать загрузку можно только по HTTP/2 (сброс потока не закрывает соединение);
+# по HTTP/1.1 хвост страницы дочитывается без хранения, иначе пул теряет соединение
+BOOSTY_STREAM = os.getenv("BOOSTY_STREAM", "1") == "1"
+BOOSTY_MAX_PAGE_BYTES = int(os.getenv("BOOSTY_MAX_PAGE_BYTES", 3 * 1024 * 1024))
+# JSON API Boosty: запрашиваем только последние посты, страницу разбираем лишь при сбое API
+BOOSTY_API = os.getenv("BOOSTY_API", "1") == "1"
+BOOSTY_API_URL = os.getenv("BOOSTY_API_URL", "https://api.boosty.to/")
+
+# Сколько последних постов страницы хранить, чтобы догонять пропущенные между проверками
+CATCHUP_MAX_POSTS = int(os.getenv("CATCHUP_MAX_POSTS", 10))
+
+# Число процессов для разбора страниц (0 — разбор в основном процессе)
+PARSE_PROCESSES = int(os.getenv("PARSE_PROCESSES", 0))
+
+# Кэш последних постов: TTL (секунды), размер LRU в памяти, второй уровень в Redis
+POST_CACHE_TTL = int(os.getenv("POST_CACHE_TTL", 60))
+POST_CACHE_SIZE = int(os.getenv("POST_CACHE_SIZE", 2000))
+POST_CACHE_REDIS = os.getenv("POST_CACHE_REDIS", "1") == "1"
+
+# Очередь уведомлений: число отправителей, лимит сообщений в секунду (общий и на чат),
+# число попыток до dead-letter и время, через которое невзятое подтверждение возвращается в очередь
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", 8))
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", 25))
+NOTIFY_CHAT_INTERVAL = float(os.getenv("NOTIFY_CHAT_INTERVAL", 1))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", 5))
+NOTIFY_VISIBILITY = int(os.getenv("NOTIFY_VISIBILITY", 60))
+# Сколько секунд при остановке ждать отправителей, прежде чем прервать их
+NOTIFY_SHUTDOWN_TIMEOUT = float(os.getenv("NOTIFY_SHUTDOWN_TIMEOUT", 10))
+
+# Вебхук: обработка апдейтов в фоне (общий лимит очереди и число обработчиков).
+# У каждого обработчика своя очередь, апдейты одного пользователя всегда попадают в одну
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "1") == "1"
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 16))
+# Токен для /metrics (заголовок Authorization: Bearer <токен>); без него эндпоинт выключен
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# /checkall: сколько каналов проверять одновременно и как часто обновлять сообщение (секунды)
+CHECKALL_CONCURRENCY = int(os.getenv("CHECKALL_CONCURRENCY", 5))
+CHECKALL_EDIT_INTERVAL = float(os.getenv("CHECKALL_EDIT_INTERVAL", 3))
+
+# Дайджест: как часто собирать созревшие дайджесты (секунды) и лимит длины сообщения Telegram
+DIGEST_FLUSH_INTERVAL = int(os.getenv("DIGEST_FLUSH_INTERVAL", 15))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Кэш подписок пользователей в памяти: число пользователей и страховочный TTL (секунды).
+# Записи сбрасываются на всех репликах через канал Redis pub/sub subs_invalidate.
+SUBS_CACHE_SIZE = int(os.getenv("SUBS_CACHE_SIZE", 10000))
+SUBS_CACHE_TTL = int(os.getenv("SUBS_CACHE_TTL", 300))
+
+# Размер пачки для SSCAN/HSCAN и конвейерных запросов к Redis
+REDIS_BATCH = int(os.getenv("REDIS_BATCH", 500))
+
+# Ответ «канал не найден» кэшируется отдельно, на более долгий срок (секунды)
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", 1800))
+# Отсрочка повторной проверки канала после ошибок: SCHEDULER_PERIOD * 2^(n-1), не больше максимума
+CHANNEL_BACKOFF_MAX = int(os.getenv("CHANNEL_BACKOFF_MAX", 24 * 3600))
+# Предохранитель к boosty.to: размыкается, если в окне доля ошибок (429/5xx/сеть) выше порога
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", 60))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", 20))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", 0.5))
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", 120))
+
+# HTTP/2 (пакет h2 из httpx[http2]): сброс потока при раннем обрыве чтения страницы не закрывает соединение
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 # Глобальные клиенты
 redis_client = None
 telegram_app = None
+http_client = None
+parse_pool = None
+update_queues = []
+migrate_user_script = None
+claim_notification_script = None
+renew_lease_script = None
+release_lease_script = None
+fan_out_script = None
+update_sub_script = None
+take_digest_script = None
+claim_due_script = None
+release_claims_script = None
+
+# Ответ 304: страница не изменилась с прошлого запроса
+NOT_MODIFIED = object()
+# Ответ 404: канала нет
+NOT_FOUND = object()
+# Предохранитель не пропустил запрос: канал не проверен, но и ошибкой это не считается
+CIRCUIT_OPEN = object()
+# API Boosty перегружен или недоступен (429, 5xx, сеть): страницу с того же сервиса не запрашиваем
+UNAVAILABLE = object()
+
+# Состояние предохранителя к boosty.to и исходы последних запросов (время, ошибка ли, Retry-After)
+boosty_breaker = {"open_until": 0.0, "trial": False}
+boosty_outcomes = deque()
+
+# Время, когда каждому чату можно писать снова (общий лимит — token bucket в Redis)
+chat_next_send = {}
+
+# Счетчики очереди апдейтов вебхука
+webhook_stats = {"accepted": 0, "rejected": 0, "processed": 0, "failed": 0}
+
+# Шарды каналов, на которые эта реплика держит аренду
+owned_shards = set()
+
+# Будит планировщик, когда у канала появился более ранний срок проверки
+scheduler_wakeup = asyncio.Event()
+
+# Слоты запросов по хостам и класс текущего запроса: (класс, user_id)
+host_fetch_lanes = {}
+fetch_context = contextvars.ContextVar("fetch_context", default=("background", ""))
+
+# Кэш последних постов: канал -> (истекает, пост), и запросы, которые уже выполняются
+post_cache = OrderedDict()
+post_inflight = {}
+cache_stats = {"hits": 0, "redis_hits": 0, "misses": 0, "coalesced": 0}
+
+# Кэш подписок: user_id -> (истекает, подписки), и версии, растущие при каждой инвалидации
+subs_cache = OrderedDict()
+subs_versions = {}
+subs_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+# ---------------- METRICS ----------------
+
+FETCH_SECONDS = Histogram("boosty_fetch_seconds", "Время загрузки страницы канала", ["result"])
+API_FETCH_SECONDS = Histogram("boosty_api_fetch_seconds", "Время запроса последних постов через API Boosty",
+                              ["result"])
+FETCH_BYTES = Histogram("boosty_fetch_bytes", "Скачано байт на страницу канала",
+                        buckets=(16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6))
+FETCH_WAIT_SECONDS = Histogram("boosty_fetch_wait_seconds", "Ожидание слота запроса к Boosty", ["lane"])
+PARSE_SECONDS = Histogram("post_parse_seconds", "Время разбора страницы в get_last_post_info")
+REDIS_SECONDS = Histogram("redis_op_seconds", "Время операций с Redis", ["op"])
+REDIS_COMMAND_SECONDS = Histogram("redis_command_seconds", "Время команд Redis (включая пайплайны и скрипты)",
+                                  ["command"])
+TELEGRAM_SEND_SECONDS = Histogram("telegram_send_seconds", "Время отправки сообщения в Telegram")
+TELEGRAM_SEND_ERRORS = Counter("telegram_send_errors_total", "Ошибки отправки в Telegram", ["error"])
+SCHEDULER_CYCLE_SECONDS = Histogram("scheduler_cycle_seconds", "Длительность прохода планировщика",
+                                    buckets=(0.5, 1, 5, 15, 30, 60, 120, 300, 600))
+SCHEDULER_LAG = Gauge("scheduler_lag_seconds", "Отставание планировщика от срока проверки в последнем проходе")
+QUEUE_DEPTH = Gauge("queue_depth", "Глубина очередей", ["queue"])
+BREAKER_OPEN = Gauge("boosty_breaker_open", "Предохранитель к boosty.to разомкнут")
+
+
+class StatsCollector:
+    """Отдает счетчики-словари (кэш постов, вебхук) в формате Prometheus"""
+
+    def collect(self):
+        for name, stats in (("post_cache", cache_stats), ("subs_cache", subs_cache_stats),
+                            ("webhook_updates", webhook_stats)):
+            family = CounterMetricFamily(f"{name}_total", f"Счетчики {name}", labels=["result"])
+            for key, value in stats.items():
+                family.add_metric([key], value)
+            yield family
+
+
+REGISTRY.register(StatsCollector())
+
+
+def redis_timed(fn):
+    """Замеряет длительность обращения к Redis в redis_op_seconds"""
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with REDIS_SECONDS.labels(fn.__name__).time():
+            return await fn(*args, **kwargs)
+
+    return wrapper
+
+
+class TimedPipeline(redis.client.Pipeline):
+    """Пайплайн, который замеряет свой execute целиком"""
+
+    async def execute(self, *args, **kwargs):
+        with REDIS_COMMAND_SECONDS.labels("pipeline").time():
+            return await super().execute(*args, **kwargs)
+
+
+class TimedRedis(redis.Redis):
+    """Клиент Redis, который замеряет каждую команду в redis_command_seconds: так видны и
+    прямые вызовы redis_client (планировщик, доставка, аренды, захват каналов), а не только db_*"""
+
+    async def execute_command(self, *args, **options):
+        with REDIS_COMMAND_SECONDS.labels(str(args[0]).lower()).time():
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+async def refresh_queue_metrics():
+    """Обновляет глубину очередей перед выдачей /metrics"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.llen("notify_queue")
+    pipe.zcard("notify_delayed")
+    pipe.zcard("notify_inflight")
+    pipe.llen("notify_dead")
+    queue, delayed, inflight, dead = await pipe.execute()
+    QUEUE_DEPTH.labels("notify").set(queue)
+    QUEUE_DEPTH.labels("notify_delayed").set(delayed)
+    QUEUE_DEPTH.labels("notify_inflight").set(inflight)
+    QUEUE_DEPTH.labels("notify_dead").set(dead)
+    QUEUE_DEPTH.labels("webhook").set(update_queue_size())
+    for lane in FETCH_LANES:
+        QUEUE_DEPTH.labels(f"fetch_{lane}").set(sum(lanes.waiting(lane) for lanes in host_fetch_lanes.values()))
 
 
 # ---------------- HELPERS ----------------
 
-def get_ngrok_url():
+def create_http_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент с пулом keep-alive соединений"""
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"},
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_KEEPALIVE),
+        follow_redirects=True,
+    )
+
+
+async def get_ngrok_url():
     """Автоматически получает URL запущенного локально ngrok"""
     try:
-        r = requests.get("http://127.0.0.1:4040/api/tunnels", timeout=2)
+        r = await http_client.get("http://127.0.0.1:4040/api/tunnels", timeout=2)
         tunnels = r.json()["tunnels"]
         for t in tunnels:
             if t["proto"] == "https":
@@ -65,123 +336,1539 @@ async def setup_commands(app):
         BotCommand("checkall", "Проверить все каналы"),
         BotCommand("reset", "Сбросить last_sent"),
         BotCommand("resetall", "Сбросить все last_sent"),
+        BotCommand("digest", "Присылать новые посты одним сообщением"),
         BotCommand("debug", "Отладочная информация"),
     ]
 
     await app.bot.set_my_commands(commands)
 
 
-async def fetch_boosty_page(channel: str, timeout=10):
+class FetchLanes:
+    """Слоты одновременных запросов к хосту с классами приоритета.
+    Освободившийся слот получает старший класс; внутри класса очередь обходит
+    пользователей по кругу, чтобы один /checkall не задерживал чужие /check.
+    Младшему классу слот дается, только пока свободны слоты, зарезервированные старшим."""
+
+    def __init__(self, size: int, reserved: dict):
+        self.in_use = 0
+        self.caps = {}
+        headroom = 0
+        for lane in FETCH_LANES:
+            self.caps[lane] = max(1, size - headroom)
+            headroom += reserved.get(lane, 0)
+        # класс -> user_id -> очередь ожидающих
+        self.waiters = {lane: OrderedDict() for lane in FETCH_LANES}
+
+    def waiting(self, lane: str) -> int:
+        return sum(len(queue) for queue in self.waiters[lane].values())
+
+    def _queued_ahead(self, lane: str) -> bool:
+        return any(self.waiters[other] for other in FETCH_LANES[:FETCH_LANES.index(lane) + 1])
+
+    def _enqueue(self, waiter: dict):
+        self.waiters[waiter["lane"]].setdefault(waiter["user"], deque()).append(waiter)
+
+    def _dequeue(self, waiter: dict):
+        users = self.waiters[waiter["lane"]]
+        queue = users.get(waiter["user"])
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del users[waiter["user"]]
+
+    def _wake(self):
+        for lane in FETCH_LANES:
+            users = self.waiters[lane]
+            while users and self.in_use < self.caps[lane]:
+                user, queue = next(iter(users.items()))
+                waiter = queue.popleft()
+                if queue:
+                    users.move_to_end(user)
+                else:
+                    del users[user]
+                # Ожидающий уже отменен, но еще не успел сам уйти из очереди — слот ему не отдаем
+                if waiter["future"].done():
+                    continue
+                self.in_use += 1
+                waiter["future"].set_result(None)
+            # У младших классов предел ниже, так что дальше искать незачем
+            if users:
+                return
+
+    def promote(self, key: str, lane: str, user: str):
+        """Поднимает класс ожидающего запроса key, если его ждет более важный вызов"""
+        for other in FETCH_LANES[FETCH_LANES.index(lane) + 1:]:
+            for queue in self.waiters[other].values():
+                for waiter in queue:
+                    if waiter["key"] == key:
+                        self._dequeue(waiter)
+                        waiter["lane"], waiter["user"] = lane, user
+                        self._enqueue(waiter)
+                        self._wake()
+                        return
+
+    @asynccontextmanager
+    async def slot(self, key: str = None):
+        lane, user = fetch_context.get()
+        started = time.perf_counter()
+        if self.in_use < self.caps[lane] and not self._queued_ahead(lane):
+            self.in_use += 1
+        else:
+            waiter = {"lane": lane, "user": user, "key": key,
+                      "future": asyncio.get_running_loop().create_future()}
+            self._enqueue(waiter)
+            try:
+                await waiter["future"]
+            except asyncio.CancelledError:
+                if waiter["future"].done() and not waiter["future"].cancelled():
+                    self.release()
+                else:
+                    self._dequeue(waiter)
+                raise
+            lane = waiter["lane"]
+        FETCH_WAIT_SECONDS.labels(lane).observe(time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self):
+        self.in_use -= 1
+        self._wake()
+
+
+def host_lanes(url: str) -> FetchLanes:
+    """Слоты, ограничивающие число одновременных запросов к хосту"""
+    host = urlsplit(url).netloc
+    if host not in host_fetch_lanes:
+        host_fetch_lanes[host] = FetchLanes(HOST_CONCURRENCY, {
+            "interactive": FETCH_RESERVED_INTERACTIVE,
+            "subscribe": FETCH_RESERVED_SUBSCRIBE,
+        })
+    return host_fetch_lanes[host]
+
+
+@contextmanager
+def fetch_priority(lane: str, user_id: str = ""):
+    """Запросы к Boosty внутри блока (и в созданных в нем задачах) идут классом lane"""
+    token = fetch_context.set((lane, user_id))
+    try:
+        yield
+    finally:
+        fetch_context.reset(token)
+
+
+async def run_bounded(jobs, limit: int, deadline: float, stop_event: asyncio.Event = None, grace: float = 0):
+    """Выполняет корутины не более чем по limit одновременно.
+    Не успевшие к дедлайну задачи отменяются. После stop_event не начатые задачи
+    отменяются сразу, а начатым дается grace секунд. Возвращает (результаты, число отмененных)"""
+    sem = asyncio.Semaphore(limit)
+    started = set()
+
+    async def worker(job):
+        try:
+            async with sem:
+                started.add(asyncio.current_task())
+                return await job
+        finally:
+            # Отмененная до старта корутина закрывается без предупреждения "never awaited"
+            job.close()
+
+    tasks = [asyncio.create_task(worker(job)) for job in jobs]
+    if not tasks:
+        return [], 0
+
+    waiters = [asyncio.create_task(asyncio.wait(tasks))]
+    if stop_event is not None:
+        waiters.append(asyncio.create_task(stop_event.wait()))
+    await asyncio.wait(waiters, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+    for w in waiters:
+        w.cancel()
+
+    if stop_event is not None and stop_event.is_set():
+        for t in tasks:
+            if t not in started:
+                t.cancel()
+        running = [t for t in started if not t.done()]
+        if running and grace > 0:
+            await asyncio.wait(running, timeout=grace)
+
+    pending = [t for t in tasks if not t.done()]
+    for t in pending:
+        t.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    done = [t for t in tasks if not t.cancelled()]
+    results = []
+    for t in done:
+        if t.exception():
+            print(f"Ошибка задачи: {t.exception()}")
+        else:
+            results.append(t.result())
+    return results, len(tasks) - len(done)
+
+
+def breaker_admit():
+    """Можно ли сейчас обращаться к Boosty: "closed" — да, "trial" — это пробный запрос
+    после паузы (его исход замкнет или снова разомкнет предохранитель), None — нет"""
+    if not boosty_breaker["open_until"]:
+        return "closed"
+    if time.monotonic() < boosty_breaker["open_until"] or boosty_breaker["trial"]:
+        return None
+    boosty_breaker["trial"] = True
+    return "trial"
+
+
+def breaker_retry_in() -> float:
+    """Сколько секунд предохранитель еще будет разомкнут"""
+    return max(boosty_breaker["open_until"] - time.monotonic(), 0)
+
+
+def breaker_open(retry_after: float = 0):
+    boosty_breaker["open_until"] = time.monotonic() + max(BREAKER_COOLDOWN, retry_after)
+    boosty_outcomes.clear()
+    BREAKER_OPEN.set(1)
+    print(f"⚠️ Предохранитель к Boosty разомкнут на {max(BREAKER_COOLDOWN, retry_after):.0f} с")
+
+
+def breaker_record(failed: bool, retry_after: float = 0, trial: bool = False):
+    """Учитывает исход запроса к Boosty и при всплеске ошибок размыкает предохранитель.
+    Retry-After сам по себе предохранитель не размыкает, а лишь удлиняет паузу"""
+    now = time.monotonic()
+    if trial:
+        boosty_breaker["trial"] = False
+        if failed:
+            breaker_open(retry_after)
+        else:
+            boosty_breaker["open_until"] = 0.0
+            BREAKER_OPEN.set(0)
+            print("Предохранитель к Boosty замкнут")
+        return
+    if boosty_breaker["open_until"]:
+        # Ответы на запросы, начатые до размыкания
+        return
+
+    boosty_outcomes.append((now, failed, retry_after))
+    while boosty_outcomes and boosty_outcomes[0][0] < now - BREAKER_WINDOW:
+        boosty_outcomes.popleft()
+    failures = sum(1 for _, f, _ in boosty_outcomes if f)
+    if len(boosty_outcomes) >= BREAKER_MIN_REQUESTS and failures / len(boosty_outcomes) >= BREAKER_ERROR_RATE:
+        breaker_open(max(r for _, _, r in boosty_outcomes))
+
+
+# Открывающий тег <script id="initial-state"> в байтах ответа
+INITIAL_STATE_TAG_RE = re.compile(rb"""<script\b[^>]*\bid=["']initial-state["'][^>]*>""")
+
+
+async def read_until_initial_state(r: httpx.Response, max_bytes: int):
+    """Читает ответ по частям до конца блока initial-state. По HTTP/2 на этом загрузка
+    обрывается, по HTTP/1.1 остаток дочитывается и отбрасывается, чтобы соединение
+    вернулось в пул. Возвращает None, если страница превысила max_bytes."""
+    buf = bytearray()
+    marker_pos = -1
+    complete = False
+    read = 0
+    async for chunk in r.aiter_bytes():
+        read += len(chunk)
+        if read > max_bytes:
+            if not complete:
+                return None
+            # Блок уже прочитан: огромный хвост дешевле бросить вместе с соединением
+            break
+        if complete:
+            continue
+        # Тег мог разорваться между частями — ищем с запасом в длину тега
+        scan_from = max(0, len(buf) - 256)
+        buf += chunk
+        if marker_pos == -1:
+            tag = INITIAL_STATE_TAG_RE.search(buf, scan_from)
+            marker_pos = tag.end() if tag else -1
+        if marker_pos != -1 and buf.find(b"</script>", marker_pos) != -1:
+            complete = True
+            if r.http_version == "HTTP/2":
+                break
+    return buf.decode(r.encoding or "utf-8", errors="replace")
+
+
+async def fetch_boosty_page(channel: str, timeout=None, validators: dict = None):
+    """Загружает страницу канала. Если переданы validators (etag/last_modified),
+    отправляет условный запрос и обновляет их по ответу.
+    При 304 возвращает NOT_MODIFIED, при 404 — NOT_FOUND, при разомкнутом
+    предохранителе — CIRCUIT_OPEN, при ошибке — None."""
+    admitted = breaker_admit()
+    if not admitted:
+        FETCH_SECONDS.labels("circuit_open").observe(0)
+        return CIRCUIT_OPEN
+
     url = f"{BOOSTY_BASE_URL}{channel}"
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-    loop = asyncio.get_running_loop()
+    kwargs = {} if timeout is None else {"timeout": timeout}
+    headers = {}
+    if validators is not None:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    started = time.perf_counter()
+    result = "error"
+    retry_after = 0
     try:
-        r = await loop.run_in_executor(None, lambda: requests.get(url, headers=headers, timeout=timeout))
-        r.raise_for_status()
-        return r.text
+        async with host_lanes(url).slot(channel):
+            if not BOOSTY_STREAM:
+                r = await http_client.get(url, headers=headers, **kwargs)
+                result = response_result(r)
+                if result != "ok":
+                    retry_after = parse_retry_after(r)
+                    return fetch_fallback(channel, r, result)
+                html = r.text
+            else:
+                async with http_client.stream("GET", url, headers=headers, **kwargs) as r:
+                    result = response_result(r)
+                    if result != "ok":
+                        retry_after = parse_retry_after(r)
+                        return fetch_fallback(channel, r, result)
+                    html = await read_until_initial_state(r, BOOSTY_MAX_PAGE_BYTES)
+        FETCH_BYTES.observe(r.num_bytes_downloaded)
+        if html is None:
+            result = "too_large"
+            print(f"Страница {channel} больше {BOOSTY_MAX_PAGE_BYTES} байт, пропускаю")
+        elif validators is not None:
+            validators["etag"] = r.headers.get("ETag")
+            validators["last_modified"] = r.headers.get("Last-Modified")
+        return html
     except Exception as e:
         print(f"Ошибка запроса к {channel}: {e}")
         return None
+    finally:
+        FETCH_SECONDS.labels(result).observe(time.perf_counter() - started)
+        breaker_record(result in ("error", "rate_limited", "server_error"), retry_after, admitted == "trial")
+
+
+async def fetch_boosty_api(channel: str, timeout=None):
+    """Последние посты канала из JSON API Boosty в том же виде, что у parse_last_post.
+    None — API не знает канал или ответ не разобрать, тогда проверяем через страницу канала.
+    UNAVAILABLE — 429, 5xx или ошибка сети; CIRCUIT_OPEN — предохранитель не пропустил запрос."""
+    admitted = breaker_admit()
+    if not admitted:
+        API_FETCH_SECONDS.labels("circuit_open").observe(0)
+        return CIRCUIT_OPEN
+
+    url = f"{BOOSTY_API_URL}v1/blog/{channel}/post/"
+    kwargs = {} if timeout is None else {"timeout": timeout}
+    started = time.perf_counter()
+    result = "error"
+    retry_after = 0
+    try:
+        async with host_lanes(url).slot(channel):
+            r = await http_client.get(url, params={"limit": CATCHUP_MAX_POSTS}, **kwargs)
+        result = response_result(r)
+        if result in ("rate_limited", "server_error"):
+            retry_after = parse_retry_after(r)
+            return UNAVAILABLE
+        if result != "ok":
+            return None
+        FETCH_BYTES.observe(r.num_bytes_downloaded)
+        result = "bad_payload"
+        post = latest_with_recent(r.json().get("data"), channel)
+        if post is not None:
+            result = "ok"
+        return post
+    except httpx.TransportError as e:
+        result = "network"
+        print(f"Ошибка запроса к API для {channel}: {e}")
+        return UNAVAILABLE
+    except Exception as e:
+        print(f"Не удалось разобрать ответ API для {channel}: {e}")
+        return None
+    finally:
+        API_FETCH_SECONDS.labels(result).observe(time.perf_counter() - started)
+        # Отказы самого API (404, другой формат) не должны размыкать предохранитель для страниц
+        breaker_record(result in ("rate_limited", "server_error", "network"), retry_after, admitted == "trial")
+
+
+def response_result(r: httpx.Response) -> str:
+    """Классифицирует ответ Boosty для метрик и предохранителя"""
+    if r.status_code == 304:
+        return "not_modified"
+    if r.status_code == 404:
+        return "not_found"
+    if r.status_code == 429:
+        return "rate_limited"
+    if r.status_code >= 500:
+        return "server_error"
+    if r.status_code >= 400:
+        return "error"
+    return "ok"
+
+
+def parse_retry_after(r: httpx.Response) -> float:
+    try:
+        return float(r.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0
+
+
+def fetch_fallback(channel: str, r: httpx.Response, result: str):
+    """Что вернуть из fetch_boosty_page для ответа, отличного от 200"""
+    if result == "not_modified":
+        return NOT_MODIFIED
+    if result == "not_found":
+        return NOT_FOUND
+    print(f"Ошибка запроса к {channel}: HTTP {r.status_code}")
+    return None
+
+
+def extract_initial_state(html: str):
+    """Вырезает содержимое <script id="initial-state"> из текста страницы без построения DOM"""
+    for marker in ('id="initial-state"', "id='initial-state'"):
+        pos = html.find(marker)
+        if pos == -1:
+            continue
+        tag_start = html.rfind("<", 0, pos)
+        if not html.startswith("<script", tag_start):
+            continue
+        start = html.find(">", pos)
+        end = html.find("</script>", start)
+        if start == -1 or end == -1:
+            return None
+        return html[start + 1:end]
+    return None
 
 
-async def get_last_post_info(channel: str):
-    html = await fetch_boosty_page(channel)
-    if not html:
-        return None
+POSTS_LIST_RE = re.compile(r'"postsList"\s*:\s*')
+json_decoder = json.JSONDecoder()
 
-    soup = BeautifulSoup(html, "html.parser")
-    script_tag = soup.find("script", {"id": "initial-state"})
-    if not script_tag:
-        return None
 
+def extract_posts_section(raw: str):
+    """Находит в тексте initial-state значение "postsList" и декодирует только его.
+    Возвращает (текст раздела, значение) или None. Ключ может встретиться и в других
+    местах состояния, поэтому берется первое вхождение со списком постов внутри"""
+    for match in POSTS_LIST_RE.finditer(raw):
+        try:
+            value, end = json_decoder.raw_decode(raw, match.end())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(value, dict) and isinstance(value.get("data"), dict) and "posts" in value["data"]:
+            return raw[match.end():end], value
+    return None
+
+
+def parse_page(html: str, channel: str):
+    """Разбирает страницу канала за один проход: (хэш раздела postsList, последний пост).
+    Хэш считается по тексту уже декодированного раздела, так что повторного разбора нет.
+    Чистая функция, чтобы ее можно было выполнять в пуле процессов."""
+    raw = extract_initial_state(html)
+    section = extract_posts_section(raw) if raw else None
+    if section is None:
+        return None, parse_last_post(html, channel)
+    text, value = section
+    return hashlib.sha1(text.encode()).hexdigest(), latest_with_recent(value["data"]["posts"], channel)
+
+
+def parse_last_post(html: str, channel: str):
+    """Достает последний пост из HTML страницы канала.
+    Чистая функция, чтобы ее можно было выполнять в пуле процессов."""
+    raw = extract_initial_state(html)
     try:
-        data = json.loads(script_tag.text)
-        posts = data["posts"]["postsList"]["data"]["posts"]
-        if not posts:
+        data = json.loads(raw) if raw else None
+    except json.JSONDecodeError:
+        data = None
+
+    if data is None:
+        # Запасной путь: полный разбор страницы
+        soup = BeautifulSoup(html, "html.parser")
+        script_tag = soup.find("script", {"id": "initial-state"})
+        if not script_tag:
+            return None
+        try:
+            data = json.loads(script_tag.text)
+        except json.JSONDecodeError:
             return None
 
-        post = posts[0]
-        return {
-            "title": post.get("title") or "(без заголовка)",
-            "link": f"{BOOSTY_BASE_URL}{post['user']['blogUrl']}/posts/{post.get('id')}",
-            "timestamp": int(post.get("publishTime")),
-            "channel": channel
-        }
-    except (KeyError, json.JSONDecodeError, IndexError):
+    try:
+        return latest_with_recent(data["posts"]["postsList"]["data"]["posts"], channel)
+    except (KeyError, TypeError):
         return None
 
-    # ---------------- REDIS LOGIC (HSET/HGET) ----------------
 
+def normalize_post(post: dict, channel: str) -> dict:
+    return {
+        "title": post.get("title") or "(без заголовка)",
+        "link": f"{BOOSTY_BASE_URL}{(post.get('user') or {}).get('blogUrl') or channel}/posts/{post['id']}",
+        "timestamp": int(post.get("publishTime")),
+        "channel": channel
+    }
 
-async def db_get_user_subs(user_id: str) -> dict:
-    """Получает все подписки пользователя из Redis Hash"""
-    data = await redis_client.hget("subscribers", str(user_id))
+
+def latest_with_recent(posts: list, channel: str):
+    """Последний пост канала; в recent — до CATCHUP_MAX_POSTS постов от новых к старым.
+    Закрепленный пост может стоять в списке первым, поэтому порядок задает publishTime."""
+    normalized = {}
+    for post in posts or []:
+        try:
+            item = normalize_post(post, channel)
+        except (KeyError, TypeError, ValueError):
+            continue
+        normalized[item["link"]] = item
+    if not normalized:
+        return None
+
+    recent = sorted(normalized.values(), key=lambda p: p["timestamp"], reverse=True)[:CATCHUP_MAX_POSTS]
+    return {**recent[0], "recent": recent}
+
+
+def posts_newer_than(post: dict, last_sent) -> list:
+    """Посты канала новее last_sent в порядке публикации. Без last_sent — только последний"""
+    if last_sent is None:
+        return [post]
+    recent = post.get("recent") or [post]
+    return sorted((p for p in recent if p["timestamp"] > last_sent), key=lambda p: p["timestamp"])
+
+
+@redis_timed
+async def db_get_validators(channel: str) -> dict:
+    """ETag/Last-Modified, хэш initial-state и последний разобранный пост канала"""
+    data = await redis_client.hget("page_validators", channel)
     return json.loads(data) if data else {}
 
 
-async def db_save_user_subs(user_id: str, subs: dict):
-    """Сохраняет подписки конкретного пользователя"""
-    await redis_client.hset("subscribers", str(user_id), json.dumps(subs))
+@redis_timed
+async def db_save_validators(channel: str, validators: dict):
+    await redis_client.hset("page_validators", channel, json.dumps(validators))
+
+
+async def get_last_post_info(channel: str):
+    """Последний пост канала с Boosty; NOT_FOUND, если канала нет, CIRCUIT_OPEN,
+    если предохранитель не пропустил запрос, None при ошибке"""
+    validators = await db_get_validators(channel)
+    post = await fetch_boosty_api(channel) if BOOSTY_API else None
+    if post is CIRCUIT_OPEN:
+        return CIRCUIT_OPEN
+    if post is UNAVAILABLE:
+        # Сервис перегружен — запрос страницы только удвоит нагрузку; ошибку учтут предохранитель и отсрочка
+        return None
+    if post:
+        if post != validators.get("post"):
+            validators["post"] = post
+            await db_save_validators(channel, validators)
+            await db_record_post(channel, post)
+        return post
+
+    # Запасной путь: страница канала (она же надежно отличает несуществующий канал)
+    html = await fetch_boosty_page(channel, validators=validators)
+    if html is CIRCUIT_OPEN:
+        return CIRCUIT_OPEN
+    if html is NOT_MODIFIED:
+        return validators.get("post")
+    if html is NOT_FOUND:
+        return NOT_FOUND
+    if not html:
+        return None
+
+    with PARSE_SECONDS.time():
+        if parse_pool:
+            loop = asyncio.get_running_loop()
+            digest, post = await loop.run_in_executor(parse_pool, parse_page, html, channel)
+        else:
+            digest, post = parse_page(html, channel)
+
+    # Хэшируем только postsList: остальной initial-state (сессия, счетчики) меняется почти
+    # на каждый запрос. Если посты те же, пост и историю канала не перезаписываем
+    if digest and digest == validators.get("hash") and validators.get("post"):
+        await db_save_validators(channel, validators)
+        return validators["post"]
+
+    if post:
+        validators["hash"] = digest
+        validators["post"] = post
+        await db_save_validators(channel, validators)
+        await db_record_post(channel, post)
+    return post
+
+
+# ---------------- POST CACHE ----------------
+
+def cache_post(channel: str, post, ttl: int = POST_CACHE_TTL):
+    """Кладет пост в LRU-кэш в памяти (None — канал не найден)"""
+    post_cache[channel] = (time.time() + ttl, post)
+    post_cache.move_to_end(channel)
+    while len(post_cache) > POST_CACHE_SIZE:
+        post_cache.popitem(last=False)
+
+
+async def load_last_post(channel: str):
+    """Промах кэша в памяти: пробуем Redis, затем идем на Boosty"""
+    if POST_CACHE_REDIS:
+        data = await redis_client.get(f"post_cache:{channel}")
+        if data:
+            cache_stats["redis_hits"] += 1
+            post = json.loads(data)
+            ttl = await redis_client.ttl(f"post_cache:{channel}")
+            cache_post(channel, post, max(ttl, 1))
+            return post
+
+    cache_stats["misses"] += 1
+    post = await get_last_post_info(channel)
+    if post is CIRCUIT_OPEN:
+        # Не кэшируем: канал проверим, как только предохранитель пропустит запрос
+        return CIRCUIT_OPEN
+    if post is NOT_FOUND:
+        # Отрицательный кэш: несуществующий канал не запрашиваем повторно NEGATIVE_CACHE_TTL секунд
+        post, ttl = None, NEGATIVE_CACHE_TTL
+    elif post:
+        ttl = POST_CACHE_TTL
+    else:
+        return None
+
+    cache_post(channel, post, ttl)
+    if POST_CACHE_REDIS:
+        await redis_client.set(f"post_cache:{channel}", json.dumps(post), ex=ttl)
+    return post
+
+
+async def get_last_post_cached(channel: str):
+    """Последний пост канала из кэша. Одновременные запросы одного канала
+    ждут один общий запрос к Boosty. CIRCUIT_OPEN — предохранитель не пропустил запрос."""
+    entry = post_cache.get(channel)
+    if entry and entry[0] > time.time():
+        post_cache.move_to_end(channel)
+        cache_stats["hits"] += 1
+        return entry[1]
+
+    task = post_inflight.get(channel)
+    if task:
+        cache_stats["coalesced"] += 1
+        # Общий запрос мог встать в очередь фоновым — ждущая его ручная проверка поднимает класс
+        lane, user = fetch_context.get()
+        for lanes in host_fetch_lanes.values():
+            lanes.promote(channel, lane, user)
+    else:
+        task = asyncio.create_task(load_last_post(channel))
+        post_inflight[channel] = task
+        task.add_done_callback(lambda _: post_inflight.pop(channel, None))
+    return await asyncio.shield(task)
+
+
+def channel_not_found(channel: str) -> bool:
+    """Канал в отрицательном кэше: Boosty недавно ответил, что его нет"""
+    entry = post_cache.get(channel)
+    return bool(entry) and entry[0] > time.time() and entry[1] is None
+
+
+async def cancel_post_fetches():
+    """Отменяет общие запросы постов: shield не дает отменить их вместе с циклом,
+    а закрытые при остановке клиенты им уже не пережить"""
+    tasks = list(post_inflight.values())
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# ---------------- REDIS LOGIC ----------------
+# Подписки хранятся в хэше subs:<user_id> (поле — канал, значение — JSON настроек),
+# множество subs_users содержит всех пользователей с подписками.
+# channel_subs:<канал> — обратный индекс подписчиков канала,
+# due_channels:<шард> — сортированные множества каналов по времени следующей проверки.
+# Старый формат: хэш subscribers, где на пользователя один JSON со всеми подписками.
+
+# Атомарный перенос одного пользователя из старого формата.
+# HSETNX не затирает то, что уже записано в новом формате.
+MIGRATE_USER_LUA = """
+local blob = redis.call('HGET', KEYS[1], ARGV[1])
+if not blob then return 0 end
+local subs = cjson.decode(blob)
+for channel, cfg in pairs(subs) do
+    redis.call('HSETNX', KEYS[2], channel, cjson.encode(cfg))
+end
+if next(subs) ~= nil then redis.call('SADD', KEYS[3], ARGV[1]) end
+redis.call('HDEL', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+# Раздача нового поста: для каждого подписчика канала атомарно продвигает last_sent
+# (если пост новее) и last_check. Возвращает минимальный интервал и пары
+# (получатель, его прежний last_sent).
+FAN_OUT_LUA = """
+local channel, ts, now = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local min_interval = nil
+local result = {}
+for i, key in ipairs(KEYS) do
+    local raw = redis.call('HGET', key, channel)
+    if raw then
+        local cfg = cjson.decode(raw)
+        local last_sent = cfg['last_sent']
+        local known = last_sent ~= nil and last_sent ~= cjson.null
+        if not known or tonumber(last_sent) < ts then
+            cfg['last_sent'] = ts
+            table.insert(result, ARGV[i + 3])
+            table.insert(result, known and tostring(last_sent) or '')
+        end
+        cfg['last_check'] = now
+        redis.call('HSET', key, channel, cjson.encode(cfg))
+        local interval = tonumber(cfg['interval']) or 6
+        if not min_interval or interval < min_interval then min_interval = interval end
+    end
+end
+table.insert(result, 1, tostring(min_interval or ''))
+return result
+"""
+
+# Атомарно дописывает поля в настройки существующей подписки, возвращает итоговый JSON
+UPDATE_SUB_LUA = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then return false end
+local cfg = cjson.decode(raw)
+for field, value in pairs(cjson.decode(ARGV[2])) do cfg[field] = value end
+local merged = cjson.encode(cfg)
+redis.call('HSET', KEYS[1], ARGV[1], merged)
+return merged
+"""
+
+
+def subs_key(user_id: str) -> str:
+    return f"subs:{user_id}"
+
+
+def shard_of(channel: str) -> int:
+    return zlib.crc32(channel.encode()) % SCHEDULER_SHARDS
+
+
+def due_key(channel: str) -> str:
+    """Индекс сроков шарда, в который попадает канал"""
+    return f"due_channels:{shard_of(channel)}"
+
+
+def next_check_at(cfg: dict) -> float:
+    """Время следующей проверки подписки (0 — проверить сразу)"""
+    if cfg.get("last_sent") is None:
+        return 0
+    return (cfg.get("last_check") or 0) + cfg.get("interval", 6) * 3600
+
+
+def schedule_subs(pipe, user_id: str, subs: dict):
+    """Добавляет в конвейер обновление обратного индекса и индекса сроков.
+    ZADD LT только приближает срок проверки канала."""
+    for channel, cfg in subs.items():
+        pipe.sadd(f"channel_subs:{channel}", str(user_id))
+        pipe.zadd(due_key(channel), {channel: next_check_at(cfg)}, lt=True)
+    scheduler_wakeup.set()
+
+
+async def db_migrate_user(user_id: str, client=None):
+    """Переносит подписки пользователя из старого хэша subscribers"""
+    return await migrate_user_script(keys=["subscribers", subs_key(user_id), "subs_users"],
+                                     args=[str(user_id)], client=client)
+
+
+async def migrate_subscribers_blob():
+    """Онлайн-миграция старого формата: проходит хэш subscribers пачками через HSCAN"""
+    migrated = 0
+    cursor = 0
+    while True:
+        cursor, chunk = await redis_client.hscan("subscribers", cursor, count=REDIS_BATCH)
+        if chunk:
+            pipe = redis_client.pipeline(transaction=False)
+            for uid in chunk:
+                await db_migrate_user(uid, client=pipe)
+            migrated += sum(await pipe.execute())
+        if cursor == 0:
+            break
+    if migrated:
+        print(f"Миграция подписок: перенесено пользователей {migrated}")
+
+
+def drop_cached_subs(user_ids):
+    """Убирает пользователей из локального кэша подписок"""
+    for uid in user_ids:
+        subs_cache.pop(uid, None)
+        subs_versions[uid] = subs_versions.get(uid, 0) + 1
+    subs_cache_stats["invalidations"] += 1
+
+
+def invalidate_subs(pipe, user_ids):
+    """Сбрасывает кэш подписок локально и добавляет в конвейер оповещение остальных реплик"""
+    user_ids = [str(uid) for uid in user_ids]
+    drop_cached_subs(user_ids)
+    pipe.publish("subs_invalidate", json.dumps(user_ids))
+
+
+async def subs_invalidation_loop(stop_event: asyncio.Event):
+    """Слушает оповещения об изменении подписок с других реплик.
+    После обрыва соединения кэш очищается целиком: сообщения могли потеряться."""
+    while not stop_event.is_set():
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe("subs_invalidate")
+            while not stop_event.is_set():
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+                if message:
+                    drop_cached_subs(json.loads(message["data"]))
+        except Exception as e:
+            print(f"Ошибка подписки на инвалидацию кэша: {e}")
+            subs_cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
 
 
+async def db_get_user_subs(user_id: str) -> dict:
+    """Получает все подписки пользователя: из кэша в памяти или из Redis Hash.
+    Возвращает копию, которую можно менять."""
+    user_id = str(user_id)
+    entry = subs_cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        subs_cache.move_to_end(user_id)
+        subs_cache_stats["hits"] += 1
+        return {ch: dict(cfg) for ch, cfg in entry[1].items()}
+
+    subs_cache_stats["misses"] += 1
+    version = subs_versions.get(user_id, 0)
+    subs = await db_load_user_subs(user_id)
+    # Пока шло чтение, подписки могли измениться — такой результат не кэшируем
+    if subs_versions.get(user_id, 0) == version:
+        subs_cache[user_id] = (time.monotonic() + SUBS_CACHE_TTL, subs)
+        subs_cache.move_to_end(user_id)
+        while len(subs_cache) > SUBS_CACHE_SIZE:
+            subs_cache.popitem(last=False)
+    return {ch: dict(cfg) for ch, cfg in subs.items()}
+
+
+@redis_timed
+async def db_load_user_subs(user_id: str) -> dict:
+    """Читает все подписки пользователя из Redis Hash"""
+    data = await redis_client.hgetall(subs_key(user_id))
+    if not data and await db_migrate_user(user_id):
+        data = await redis_client.hgetall(subs_key(user_id))
+    return {ch: json.loads(cfg) for ch, cfg in data.items()}
+
+
+@redis_timed
+async def db_save_sub(user_id: str, channel: str, cfg: dict):
+    """Сохраняет одну подписку пользователя"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(subs_key(user_id), channel, json.dumps(cfg))
+    pipe.sadd("subs_users", str(user_id))
+    schedule_subs(pipe, user_id, {channel: cfg})
+    invalidate_subs(pipe, [user_id])
+    await pipe.execute()
+
+
+@redis_timed
+async def db_save_user_subs(user_id: str, subs: dict):
+    """Сохраняет переданные подписки пользователя (остальные поля не трогает)"""
+    if not subs:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(subs_key(user_id), mapping={ch: json.dumps(cfg) for ch, cfg in subs.items()})
+    pipe.sadd("subs_users", str(user_id))
+    schedule_subs(pipe, user_id, subs)
+    invalidate_subs(pipe, [user_id])
+    await pipe.execute()
+
+
+@redis_timed
+async def db_update_subs(user_id: str, updates: dict) -> dict:
+    """Меняет отдельные поля подписок без чтения-изменения-записи на клиенте.
+    updates: канал -> {поле: значение}. Возвращает обновленные настройки существующих подписок."""
+    pipe = redis_client.pipeline(transaction=False)
+    for channel, fields in updates.items():
+        await update_sub_script(keys=[subs_key(user_id)], args=[channel, json.dumps(fields)], client=pipe)
+    merged = {ch: json.loads(cfg) for ch, cfg in zip(updates, await pipe.execute()) if cfg}
+
+    pipe = redis_client.pipeline(transaction=False)
+    schedule_subs(pipe, user_id, merged)
+    invalidate_subs(pipe, [user_id])
+    await pipe.execute()
+    return merged
+
+
+async def db_update_sub(user_id: str, channel: str, **fields):
+    return (await db_update_subs(user_id, {channel: fields})).get(channel)
+
+
+@redis_timed
+async def db_fan_out(channel: str, timestamp: int, uids: list):
+    """Продвигает last_sent/last_check подписчиков канала Lua-скриптом, пачками по REDIS_BATCH.
+    Возвращает ({получатель: прежний last_sent}, минимальный интервал или None)"""
+    recipients = {}
+    min_interval = None
+    now = int(time.time())
+    for i in range(0, len(uids), REDIS_BATCH):
+        batch = uids[i:i + REDIS_BATCH]
+        interval, *chunk = await fan_out_script(keys=[subs_key(uid) for uid in batch],
+                                                args=[channel, timestamp, now, *batch])
+        for uid, prev in zip(chunk[::2], chunk[1::2]):
+            recipients[uid] = int(float(prev)) if prev else None
+        # Кэш сбрасываем только тем, у кого сменился last_sent: устаревший last_check
+        # в кэше лишь показывается в /list и живет не дольше SUBS_CACHE_TTL
+        if chunk:
+            pipe = redis_client.pipeline(transaction=False)
+            invalidate_subs(pipe, chunk[::2])
+            await pipe.execute()
+        if interval:
+            min_interval = min(float(interval), min_interval or float(interval))
+    return recipients, min_interval
+
+
+@redis_timed
+async def db_delete_sub(user_id: str, channel: str):
+    """Удаляет подписку; пользователь без подписок убирается из subs_users,
+    канал без подписчиков — из индекса сроков"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hdel(subs_key(user_id), channel)
+    pipe.srem(f"channel_subs:{channel}", str(user_id))
+    pipe.hlen(subs_key(user_id))
+    pipe.scard(f"channel_subs:{channel}")
+    invalidate_subs(pipe, [user_id])
+    _, _, user_left, channel_left, _ = await pipe.execute()
+    if not user_left:
+        await redis_client.srem("subs_users", str(user_id))
+    if not channel_left:
+        await redis_client.zrem(due_key(channel), channel)
+
+
+@redis_timed
 async def db_get_all_users():
-    """Возвращает все ключи (user_id) из хэша"""
-    return await redis_client.hkeys("subscribers")
+    """Возвращает всех пользователей с подписками (SSCAN пачками)"""
+    return [uid async for uid in redis_client.sscan_iter("subs_users", count=REDIS_BATCH)]
+
+
+async def rebuild_due_index():
+    """Строит обратный индекс каналов и индекс сроков проверки по всем подпискам.
+    Выполняется одной репликой; в due_index_shards запоминается число шардов."""
+    if not await redis_client.set("due_index_lock", REPLICA_ID, nx=True, ex=600):
+        return
+    try:
+        # Чекпоинты планировщика привязаны к старой нарезке шардов: захваты в них ссылаются на
+        # ключи, которых после перестройки не будет, а шарды сверх нового числа никто не снимет
+        stale = [k for pattern in ("due_channels*", "scheduler_checkpoint*")
+                 async for k in redis_client.scan_iter(pattern, count=REDIS_BATCH)]
+        if stale:
+            await redis_client.delete(*stale)
+        user_ids = await db_get_all_users()
+        for i in range(0, len(user_ids), REDIS_BATCH):
+            users = await db_get_users_subs(user_ids[i:i + REDIS_BATCH])
+            pipe = redis_client.pipeline(transaction=False)
+            for uid, subs in users.items():
+                schedule_subs(pipe, uid, subs)
+            await pipe.execute()
+        await redis_client.set("due_index_shards", SCHEDULER_SHARDS)
+        print(f"Индекс сроков проверки построен: пользователей {len(user_ids)}, шардов {SCHEDULER_SHARDS}")
+    finally:
+        await redis_client.delete("due_index_lock")
+
+
+@redis_timed
+async def db_channel_interval(channel: str, user_ids) -> float:
+    """Минимальный интервал (часы) подписчиков канала; None, если подписок уже нет"""
+    intervals = []
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), REDIS_BATCH):
+        pipe = redis_client.pipeline(transaction=False)
+        for uid in user_ids[i:i + REDIS_BATCH]:
+            pipe.hget(subs_key(uid), channel)
+        intervals += [json.loads(cfg).get("interval", 6) for cfg in await pipe.execute() if cfg]
+    return min(intervals, default=None)
+
+
+@redis_timed
+async def db_get_users_subs(user_ids) -> dict:
+    """Подписки нескольких пользователей: конвейерные HGETALL пачками"""
+    result = {}
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), REDIS_BATCH):
+        batch = user_ids[i:i + REDIS_BATCH]
+        pipe = redis_client.pipeline(transaction=False)
+        for uid in batch:
+            pipe.hgetall(subs_key(uid))
+        for uid, data in zip(batch, await pipe.execute()):
+            result[uid] = {ch: json.loads(cfg) for ch, cfg in data.items()}
+    return result
+
+
+# ---------------- DELIVERY QUEUE ----------------
+# notify_queue — готовые к отправке задания, notify_delayed — отложенные повторы,
+# notify_inflight — взятые в работу (по сроку возврата в очередь), notify_dead — исчерпавшие попытки,
+# notify_paused_until — до какого времени Telegram просил не отправлять,
+# notify_bucket — token bucket общего лимита NOTIFY_RATE (tokens, updated). Оба общие для всех реплик.
+
+# Переносит созревшие повторы и просроченные взятые задания в очередь и берет одно задание,
+# если есть токен общего лимита и нет паузы flood control.
+# Возвращает {задание или '', когда пробовать снова ('0' — когда появятся задания)}
+CLAIM_NOTIFICATION_LUA = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[3])
+local paused_until = tonumber(redis.call('GET', KEYS[4]) or '0')
+if paused_until > now then return {'', tostring(paused_until)} end
+local bucket = redis.call('HMGET', KEYS[5], 'tokens', 'updated')
+local tokens = tonumber(bucket[1] or ARGV[3])
+local updated = tonumber(bucket[2] or ARGV[1])
+tokens = math.min(rate, tokens + math.max(now - updated, 0) * rate)
+if tokens < 1 then
+    redis.call('HSET', KEYS[5], 'tokens', tostring(tokens), 'updated', tostring(now))
+    return {'', tostring(now + (1 - tokens) / rate)}
+end
+for _, job in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 100)) do
+    redis.call('ZREM', KEYS[2], job)
+    redis.call('RPUSH', KEYS[1], job)
+end
+for _, job in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now, 'LIMIT', 0, 100)) do
+    redis.call('ZREM', KEYS[3], job)
+    redis.call('LPUSH', KEYS[1], job)
+end
+local job = redis.call('LPOP', KEYS[1])
+if job then
+    tokens = tokens - 1
+    redis.call('ZADD', KEYS[3], now + tonumber(ARGV[2]), job)
+end
+redis.call('HSET', KEYS[5], 'tokens', tostring(tokens), 'updated', tostring(now))
+return {job or '', '0'}
+"""
+
+
+@redis_timed
+async def enqueue_notifications(messages):
+    """Ставит сообщения (chat_id, text) в очередь отправки одним конвейером"""
+    messages = list(messages)
+    for i in range(0, len(messages), REDIS_BATCH):
+        jobs = [json.dumps({"id": uuid.uuid4().hex, "chat_id": str(chat_id), "text": text, "attempts": 0})
+                for chat_id, text in messages[i:i + REDIS_BATCH]]
+        await redis_client.rpush("notify_queue", *jobs)
+
+
+def reserve_chat_send(chat_id: str) -> float:
+    """Занимает очередное окно отправки в чат. Возвращает время (unix) этого окна"""
+    now = time.time()
+    if len(chat_next_send) > 10000:
+        for chat in [chat for chat, at in chat_next_send.items() if at <= now]:
+            del chat_next_send[chat]
+    slot = max(now, chat_next_send.get(chat_id, 0))
+    chat_next_send[chat_id] = slot + NOTIFY_CHAT_INTERVAL
+    return slot
+
+
+@redis_timed
+async def finish_job(raw: str, retry_at: float = None, dead_reason: str = None, job: dict = None):
+    """Снимает задание из взятых: подтверждает, откладывает повтор или отправляет в dead-letter"""
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.zrem("notify_inflight", raw)
+    if dead_reason:
+        pipe.rpush("notify_dead", json.dumps({**job, "error": dead_reason}))
+    elif retry_at:
+        pipe.zadd("notify_delayed", {json.dumps(job): retry_at})
+    await pipe.execute()
+
+
+async def deliver(raw: str):
+    """Отправляет одно задание из очереди с учетом лимитов Telegram"""
+    job = json.loads(raw)
+    # Задание, отложенное до своего окна в чате, окно уже заняло
+    if not job.pop("slot", None):
+        slot = reserve_chat_send(job["chat_id"])
+        if slot > time.time():
+            # Не держим отправителя: задание ждет окна чата в отложенных, порядок сохраняется.
+            # Токен общего лимита не потрачен на отправку — возвращаем
+            await redis_client.hincrbyfloat("notify_bucket", "tokens", 1)
+            await finish_job(raw, retry_at=slot, job={**job, "slot": slot})
+            return
+    try:
+        try:
+            with TELEGRAM_SEND_SECONDS.time():
+                await telegram_app.bot.send_message(chat_id=job["chat_id"], text=job["text"], parse_mode="HTML")
+        except Exception as e:
+            TELEGRAM_SEND_ERRORS.labels(type(e).__name__).inc()
+            raise
+        await finish_job(raw)
+    except RetryAfter as e:
+        # Flood control: ставим на паузу отправителей всех реплик, попытку не считаем
+        delay = e.retry_after
+        await redis_client.set("notify_paused_until", time.time() + delay, px=int(delay * 1000) + 1000)
+        await finish_job(raw, retry_at=time.time() + delay, job=job)
+    except (Forbidden, BadRequest) as e:
+        # Бот заблокирован или чат не найден — повтор не поможет
+        await finish_job(raw, dead_reason=str(e), job=job)
+    except Exception as e:
+        job["attempts"] += 1
+        if job["attempts"] >= NOTIFY_MAX_ATTEMPTS:
+            print(f"Ошибка отправки {job['chat_id']}, попытки исчерпаны: {e}")
+            await finish_job(raw, dead_reason=str(e), job=job)
+        else:
+            await finish_job(raw, retry_at=time.time() + 5 * 2 ** job["attempts"], job=job)
+
+
+async def delivery_worker(stop_event: asyncio.Event):
+    """Отправитель: забирает задания из очереди, пока не остановлен.
+    Токен общего лимита выдается вместе с заданием, так что ожидание не съедает срок видимости"""
+    while not stop_event.is_set():
+        try:
+            raw, retry_at = await claim_notification_script(
+                keys=["notify_queue", "notify_delayed", "notify_inflight", "notify_paused_until", "notify_bucket"],
+                args=[time.time(), NOTIFY_VISIBILITY, NOTIFY_RATE])
+            if raw:
+                await deliver(raw)
+                continue
+
+            # Ждем токен, конец паузы flood control или новые задания
+            retry_at = float(retry_at)
+            delay = max(retry_at - time.time(), 0.01) if retry_at else 0.5
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        except Exception as e:
+            print(f"Ошибка очереди уведомлений: {e}")
+            await asyncio.sleep(5)
+
+
+# ---------------- DIGEST ----------------
+# digest_windows — окно дайджеста пользователя в минутах (нет поля — дайджест выключен),
+# digest:<user_id> — накопленные посты, digest_due — пользователи по времени отправки дайджеста.
+
+# Забирает накопленные посты пользователя и снимает его из очереди дайджестов
+TAKE_DIGEST_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return items
+"""
+
+
+@redis_timed
+async def db_get_digest_windows(user_ids: list) -> dict:
+    """Окна дайджеста (минуты) для тех пользователей, у кого он включен"""
+    if not user_ids:
+        return {}
+    windows = await redis_client.hmget("digest_windows", user_ids)
+    return {uid: int(w) for uid, w in zip(user_ids, windows) if w}
+
+
+@redis_timed
+async def add_to_digests(channel: str, posts_by_user: dict, windows: dict):
+    """Добавляет посты в дайджесты; первый пост в дайджесте задает время его отправки"""
+    now = time.time()
+    pipe = redis_client.pipeline(transaction=False)
+    for uid, minutes in windows.items():
+        items = [json.dumps({"channel": channel, "post": post}) for post in posts_by_user[uid]]
+        pipe.rpush(f"digest:{uid}", *items)
+        pipe.zadd("digest_due", {uid: now + minutes * 60}, nx=True)
+    await pipe.execute()
+
+
+HTML_TAG_RE = re.compile(r"<(/?)(\w+)[^>]*>")
+
+
+def clip_html(text: str, limit: int) -> str:
+    """Обрезает HTML-строку до limit символов с многоточием: не рвет теги и сущности
+    и закрывает оставшиеся открытыми теги, чтобы Telegram принял разметку"""
+    if len(text) <= limit:
+        return text
+    cut = limit - 1
+    while True:
+        head = text[:cut]
+        lt = head.rfind("<")
+        if lt > head.rfind(">"):
+            head = head[:lt]
+        amp = head.rfind("&")
+        if amp > head.rfind(";") and len(head) - amp <= 10:
+            head = head[:amp]
+        opened = []
+        for match in HTML_TAG_RE.finditer(head):
+            if not match.group(1):
+                opened.append(match.group(2))
+            elif opened and opened[-1] == match.group(2):
+                opened.pop()
+        closing = "".join(f"</{tag}>" for tag in reversed(opened))
+        clipped = f"{head}…{closing}"
+        if len(clipped) <= limit:
+            return clipped
+        cut -= len(closing)
+
+
+def split_message(header: str, lines: list) -> list:
+    """Склеивает строки в сообщения, начиная новое только у лимита длины Telegram.
+    Строку, которая одна не влезает в сообщение, обрезаем"""
+    messages = []
+    current = header
+    for line in lines:
+        line = clip_html(line, TELEGRAM_MESSAGE_LIMIT - len(header))
+        if len(current) + len(line) > TELEGRAM_MESSAGE_LIMIT:
+            messages.append(current)
+            current = ""
+        current += line
+    messages.append(current)
+    return messages
+
+
+def digest_messages(items: list) -> list:
+    """Собирает дайджест из постов разных каналов"""
+    lines = [f"• <b>{item['channel']}</b>, {human_date_from_ts(item['post']['timestamp'])}\n"
+             f"  <a href='{item['post']['link']}'>{item['post']['title']}</a>\n"
+             for item in sorted(items, key=lambda i: i["post"]["timestamp"])]
+    return split_message(f"📬 <b>Новые посты: {len(items)}</b>\n\n", lines)
+
+
+async def flush_digests():
+    """Отправляет в очередь уведомлений дайджесты, у которых истекло окно"""
+    due = await redis_client.zrangebyscore("digest_due", "-inf", time.time(), start=0, num=REDIS_BATCH)
+    for uid in due:
+        raw = await take_digest_script(keys=[f"digest:{uid}", "digest_due"], args=[uid])
+        items = [json.loads(i) for i in raw]
+        if len(items) == 1:
+            await enqueue_notifications([(uid, post_message_text(items[0]["channel"], items[0]["post"]))])
+        elif items:
+            await enqueue_notifications((uid, text) for text in digest_messages(items))
+
+
+async def digest_loop(stop_event: asyncio.Event):
+    while not stop_event.is_set():
+        try:
+            await flush_digests()
+        except Exception as e:
+            print(f"Ошибка отправки дайджестов: {e}")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=DIGEST_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
 
 
 # ---------------- CORE LOGIC ----------------
 
+def post_message_text(channel: str, post: dict) -> str:
+    return (f"🔔 <b>Новый пост на {channel}!</b>\n"
+            f"📅 {human_date_from_ts(post['timestamp'])}\n\n"
+            f"🔗 <a href='{post['link']}'>{post['title']}</a>")
+
+
+def channel_posts_messages(channel: str, posts: list) -> list:
+    """Уведомление о новых постах канала: один пост — как раньше, несколько — списком"""
+    if len(posts) == 1:
+        return [post_message_text(channel, posts[0])]
+    lines = [f"📅 {human_date_from_ts(p['timestamp'])} — <a href='{p['link']}'>{p['title']}</a>\n" for p in posts]
+    return split_message(f"🔔 <b>Новые посты на {channel}: {len(posts)}</b>\n\n", lines)
+
+
+async def fan_out_post(channel: str, post: dict, uids: list, skip_msg=False, digest=False):
+    """Отмечает пост у подписчиков и ставит уведомления тем, для кого он новый,
+    вместе со всеми пропущенными с их last_sent постами.
+    С digest=True пользователи с включенным дайджестом получат посты в нем.
+    Возвращает (получатели, минимальный интервал подписчиков)"""
+    recipients, min_interval = await db_fan_out(channel, post["timestamp"], uids)
+    if recipients and not skip_msg:
+        new_posts = {uid: posts_newer_than(post, prev) for uid, prev in recipients.items()}
+        windows = await db_get_digest_windows(list(recipients)) if digest else {}
+        if windows:
+            await add_to_digests(channel, new_posts, windows)
+
+        # У большинства подписчиков набор новых постов совпадает — текст собираем один раз
+        texts = {}
+        messages = []
+        for uid, posts in new_posts.items():
+            if uid in windows:
+                continue
+            key = tuple(p["timestamp"] for p in posts)
+            if key not in texts:
+                texts[key] = channel_posts_messages(channel, posts)
+            messages += [(uid, text) for text in texts[key]]
+        await enqueue_notifications(messages)
+    return list(recipients), min_interval
+
+
 async def check_and_notify(user_id: str, channel: str, user_subs: dict, skip_msg=False):
     """Логика проверки одного канала для одного юзера"""
-    post = await get_last_post_info(channel)
-    if not post: return False
+    post = await get_last_post_cached(channel)
+    if not post or post is CIRCUIT_OPEN: return False
+
+    recipients, _ = await fan_out_post(channel, post, [user_id], skip_msg)
+    if recipients and channel in user_subs:
+        user_subs[channel]["last_sent"] = post["timestamp"]
+    return bool(recipients)
+
+
+# ---------------- SHARD LEASES ----------------
+# lease:shard:<n> — аренда шарда (значение — REPLICA_ID, истекает через SCHEDULER_LEASE_TTL),
+# replicas — живые реплики по времени последнего heartbeat.
+
+RENEW_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+async def refresh_leases():
+    """Heartbeat реплики: продлевает свои аренды, отдает лишние и забирает свободные
+    шарды до справедливой доли (шарды упавших реплик освобождаются по истечении аренды)"""
+    now = time.time()
+    ttl_ms = SCHEDULER_LEASE_TTL * 1000
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zadd("replicas", {REPLICA_ID: now})
+    pipe.zremrangebyscore("replicas", "-inf", now - SCHEDULER_LEASE_TTL)
+    pipe.zcard("replicas")
+    *_, replicas = await pipe.execute()
+    fair_share = -(-SCHEDULER_SHARDS // max(replicas, 1))
+
+    for shard in sorted(owned_shards):
+        if not await renew_lease_script(keys=[f"lease:shard:{shard}"], args=[REPLICA_ID, ttl_ms]):
+            owned_shards.discard(shard)
+            print(f"Аренда шарда {shard} потеряна")
+
+    while len(owned_shards) > fair_share:
+        shard = owned_shards.pop()
+        await release_lease_script(keys=[f"lease:shard:{shard}"], args=[REPLICA_ID])
+
+    for shard in range(SCHEDULER_SHARDS):
+        if len(owned_shards) >= fair_share:
+            break
+        if shard not in owned_shards and await redis_client.set(f"lease:shard:{shard}", REPLICA_ID,
+                                                                nx=True, px=ttl_ms):
+            owned_shards.add(shard)
+            scheduler_wakeup.set()
+
+    # Каналы, которые упавшая реплика взяла и не успела проверить, продолжаем проверять сразу
+    for shard in sorted(owned_shards):
+        resumed = await db_release_claims(shard, replica="")
+        if resumed:
+            print(f"Шард {shard}: возвращено в индекс {resumed} каналов от упавшей реплики")
+            scheduler_wakeup.set()
+
+
+async def lease_loop(stop_event: asyncio.Event):
+    """Обновляет аренды шардов, пока реплика работает, и отпускает их при остановке"""
+    while not stop_event.is_set():
+        try:
+            await refresh_leases()
+        except Exception as e:
+            print(f"Ошибка аренды шардов: {e}")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=SCHEDULER_LEASE_TTL / 3)
+        except asyncio.TimeoutError:
+            pass
 
-    last_sent = user_subs.get(channel, {}).get("last_sent")
-    is_new = last_sent is None or post["timestamp"] > last_sent
+    for shard in list(owned_shards):
+        await release_lease_script(keys=[f"lease:shard:{shard}"], args=[REPLICA_ID])
+    owned_shards.clear()
+    await redis_client.zrem("replicas", REPLICA_ID)
 
-    if is_new:
-        if not skip_msg:
-            text = (f"🔔 <b>Новый пост на {channel}!</b>\n"
-                    f"📅 {human_date_from_ts(post['timestamp'])}\n\n"
-                    f"🔗 <a href='{post['link']}'>{post['title']}</a>")
-            try:
-                await telegram_app.bot.send_message(chat_id=user_id, text=text, parse_mode="HTML")
-            except Exception as e:
-                print(f"Ошибка отправки {user_id}: {e}")
 
-        # Обновляем данные
-        user_subs[channel]["last_sent"] = post["timestamp"]
-        user_subs[channel]["last_check"] = int(time.time())
-        return True
-    return False
+# ---------------- ADAPTIVE POLLING ----------------
+# post_history:<канал> — время публикации последних ADAPTIVE_HISTORY постов канала
+
+@redis_timed
+async def db_record_post(channel: str, post: dict):
+    """Запоминает время публикации последних постов в истории канала"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zadd(f"post_history:{channel}", {str(p["timestamp"]): p["timestamp"] for p in post.get("recent") or [post]})
+    pipe.zremrangebyrank(f"post_history:{channel}", 0, -ADAPTIVE_HISTORY - 1)
+    await pipe.execute()
+
+
+@redis_timed
+async def db_get_post_history(channel: str) -> list:
+    return [int(ts) for ts in await redis_client.zrange(f"post_history:{channel}", 0, -1)]
+
+
+def adaptive_delay(timestamps: list, interval_hours: float, now: float) -> float:
+    """Через сколько секунд проверять канал: несколько проверок на ожидаемый
+    промежуток между постами, чаще в часы, когда канал обычно публикует.
+    Не дольше интервала пользователя: адаптация только учащает проверки"""
+    base = interval_hours * 3600
+    if len(timestamps) < ADAPTIVE_MIN_POSTS:
+        return base
+
+    timestamps = sorted(timestamps)
+    gaps = sorted(b - a for a, b in zip(timestamps, timestamps[1:]) if b > a)
+    if not gaps:
+        return base
+
+    # Медианный промежуток; если канал молчит дольше обычного, он, вероятно, стал реже
+    expected_gap = max(gaps[len(gaps) // 2], now - timestamps[-1])
+    delay = expected_gap / ADAPTIVE_CHECKS_PER_POST
+
+    # Доля постов в текущем часе (UTC) относительно среднего, со сглаживанием
+    hours = [datetime.fromtimestamp(ts, timezone.utc).hour for ts in timestamps]
+    current_hour = datetime.fromtimestamp(now, timezone.utc).hour
+    activity = (hours.count(current_hour) + 1) / (len(hours) + 24) * 24
+    delay /= min(max(activity, 0.5), 2)
+
+    return min(max(delay, base / ADAPTIVE_RANGE), base)
 
 
 # ---------------- SCHEDULER ----------------
+# scheduler_checkpoint:<шард> — каналы, взятые в работу: канал -> JSON с прежним сроком,
+# сроком захвата и репликой. Пока канал проверяется, его срок в индексе сдвинут на время
+# захвата, поэтому другая реплика (например, новая при деплое) его не возьмет.
+# Взятое, но не проверенное возвращается в индекс при остановке, а после падения
+# реплики — тем, кто держит шард, как только реплика пропадет из replicas.
+
+CLAIM_DUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[3])
+for i = 1, #due, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[2], due[i])
+    redis.call('HSET', KEYS[2], due[i], cjson.encode({
+        score = tonumber(due[i + 1]), claimed_until = tonumber(ARGV[2]), replica = ARGV[4]
+    }))
+end
+return due
+"""
+
+# Снимает захват: канал, срок которого все еще равен сроку захвата (не проверен),
+# получает прежний срок. ARGV[1] — своя реплика или '' для захватов упавших реплик,
+# чей heartbeat старше ARGV[2]; дальше — каналы (без них — весь чекпоинт шарда).
+RELEASE_CLAIMS_LUA = """
+local channels = {}
+for i = 3, #ARGV do channels[#channels + 1] = ARGV[i] end
+if #channels == 0 then channels = redis.call('HKEYS', KEYS[2]) end
+local released = 0
+for _, channel in ipairs(channels) do
+    local raw = redis.call('HGET', KEYS[2], channel)
+    if raw then
+        local claim = cjson.decode(raw)
+        local seen = tonumber(redis.call('ZSCORE', KEYS[3], claim['replica']) or '0')
+        if claim['replica'] == ARGV[1] or (ARGV[1] == '' and seen < tonumber(ARGV[2])) then
+            if tonumber(redis.call('ZSCORE', KEYS[1], channel)) == claim['claimed_until'] then
+                redis.call('ZADD', KEYS[1], claim['score'], channel)
+                released = released + 1
+            end
+            redis.call('HDEL', KEYS[2], channel)
+        end
+    end
+end
+return released
+"""
+
+
+@redis_timed
+async def db_claim_due(shard: int, now: float, limit: int) -> list:
+    """Забирает до limit просроченных каналов шарда. Возвращает [(канал, срок)]"""
+    reply = await claim_due_script(keys=[f"due_channels:{shard}", f"scheduler_checkpoint:{shard}"],
+                                   args=[now, int(now) + SCHEDULER_CLAIM_TTL, limit, REPLICA_ID])
+    return [(channel, float(score)) for channel, score in zip(reply[::2], reply[1::2])]
+
+
+@redis_timed
+async def db_release_claims(shard: int, channels=(), replica: str = REPLICA_ID) -> int:
+    """Снимает захваты каналов шарда; replica='' — захваты упавших реплик.
+    Возвращает число каналов, вернувшихся в индекс"""
+    return await release_claims_script(
+        keys=[f"due_channels:{shard}", f"scheduler_checkpoint:{shard}", "replicas"],
+        args=[replica, time.time() - SCHEDULER_LEASE_TTL, *channels])
+
+
+async def check_channel(channel: str):
+    """Проверяет канал из индекса сроков: один запрос к Boosty, результат
+    раздается всем подписчикам, затем канал переносится на следующий срок"""
+    uids = list(await redis_client.smembers(f"channel_subs:{channel}"))
+    if not uids:
+        await redis_client.zrem(due_key(channel), channel)
+        return
 
-async def scheduler_loop(stop_event: asyncio.Event):
-    print("Планировщик запущен")
-    while not stop_event.is_set():
-        try:
-            user_ids = await db_get_all_users()
-            now = time.time()
+    now = time.time()
+    post = CIRCUIT_OPEN if breaker_retry_in() else await get_last_post_cached(channel)
+    if post is CIRCUIT_OPEN:
+        # Boosty недоступен целиком или идет пробный запрос — переносим канал, не засчитывая ему ошибку
+        await redis_client.zadd(due_key(channel), {channel: now + breaker_retry_in() + random.uniform(0, 60)})
+        return
+    if not post and channel_not_found(channel):
+        # Экспоненциальная отсрочка для канала, которого нет на Boosty
+        failures = await redis_client.hincrby("channel_failures", channel, 1)
+        delay = min(SCHEDULER_PERIOD * 2 ** (failures - 1), CHANNEL_BACKOFF_MAX)
+        await redis_client.zadd(due_key(channel), {channel: now + delay})
+        return
+    if not post:
+        # Временная ошибка (таймаут, 5xx): проверим в обычный срок, без отсрочки
+        interval = await db_channel_interval(channel, uids)
+        if interval is None:
+            await redis_client.zrem(due_key(channel), channel)
+        else:
+            await redis_client.zadd(due_key(channel), {channel: now + interval * 3600})
+        return
+    await redis_client.hdel("channel_failures", channel)
+
+    _, interval = await fan_out_post(channel, post, uids, digest=True)
+    if interval is None:
+        await redis_client.zrem(due_key(channel), channel)
+        return
 
-            for uid in user_ids:
-                subs = await db_get_user_subs(uid)
-                changed = False
-                for channel, cfg in subs.items():
-                    interval_sec = cfg.get("interval", 6) * 3600
-                    last_sent = cfg.get("last_sent") or 0
+    if ADAPTIVE_POLLING:
+        next_due = now + adaptive_delay(await db_get_post_history(channel), interval, now)
+    else:
+        next_due = now + interval * 3600
+    await redis_client.zadd(due_key(channel), {channel: next_due})
+
+
+async def run_scheduler_cycle(stop_event: asyncio.Event = None):
+    """Проверяет каналы своих шардов, срок которых наступил. Возвращает число взятых каналов"""
+    started = time.monotonic()
+    now = time.time()
+    per_shard = -(-SCHEDULER_BATCH // max(len(owned_shards), 1))
+    claimed = {}
+    for shard in list(owned_shards):
+        claimed[shard] = await db_claim_due(shard, now, per_shard)
+    due = sorted((item for items in claimed.values() for item in items), key=lambda item: item[1])
+    if not due:
+        SCHEDULER_LAG.set(0)
+        return 0
 
-                    if now - last_sent >= interval_sec:
-                        if await check_and_notify(uid, channel, subs):
-                            changed = True
+    try:
+        jobs = [check_channel(channel) for channel, _ in due]
+        _, cancelled = await run_bounded(jobs, SCHEDULER_CONCURRENCY, SCHEDULER_CYCLE_DEADLINE,
+                                         stop_event, SCHEDULER_STOP_GRACE)
+    finally:
+        # Непроверенные каналы возвращаются в индекс со старым сроком
+        for shard, items in claimed.items():
+            if items:
+                await db_release_claims(shard, [channel for channel, _ in items])
+
+    duration = time.monotonic() - started
+    lag = max((now - score for _, score in due if score > 0), default=0)
+    SCHEDULER_CYCLE_SECONDS.observe(duration)
+    SCHEDULER_LAG.set(lag)
+    print(f"Цикл планировщика: {duration:.1f} с, каналов {len(due)}, не успели {cancelled}, "
+          f"отставание {lag:.0f} с")
+    if lag > SCHEDULER_PERIOD:
+        print(f"⚠️ Планировщик отстает от сроков проверки на {lag:.0f} с")
+    return len(due)
+
+
+async def seconds_until_next_due() -> float:
+    """Сколько спать до ближайшего срока проверки в своих шардах (не дольше SCHEDULER_PERIOD)"""
+    pipe = redis_client.pipeline(transaction=False)
+    for shard in owned_shards:
+        pipe.zrange(f"due_channels:{shard}", 0, 0, withscores=True)
+    firsts = [first[0][1] for first in await pipe.execute() if first]
+    if not firsts:
+        return SCHEDULER_PERIOD
+    return min(max(min(firsts) - time.time(), 0), SCHEDULER_PERIOD)
 
-                if changed:
-                    await db_save_user_subs(uid, subs)
 
-            await asyncio.wait_for(stop_event.wait(), timeout=300)  # Проверка каждые 5 мин
-        except asyncio.TimeoutError:
-            pass
+async def scheduler_loop(stop_event: asyncio.Event):
+    await migrate_subscribers_blob()
+    while not stop_event.is_set() and await redis_client.get("due_index_shards") != str(SCHEDULER_SHARDS):
+        await rebuild_due_index()
+        await asyncio.sleep(1)
+    print(f"Планировщик запущен, реплика {REPLICA_ID}")
+    while not stop_event.is_set():
+        try:
+            scheduler_wakeup.clear()
+            if await run_scheduler_cycle(stop_event) >= SCHEDULER_BATCH:
+                continue
+
+            # Спим до ближайшего срока, новой подписки или остановки
+            delay = await seconds_until_next_due()
+            waiters = [asyncio.create_task(stop_event.wait()), asyncio.create_task(scheduler_wakeup.wait())]
+            await asyncio.wait(waiters, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            for w in waiters:
+                w.cancel()
         except Exception as e:
             print(f"Ошибка планировщика: {e}")
             await asyncio.sleep(10)
@@ -212,6 +1899,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/checkall — проверить все каналы сейчас\n"
         "/reset <code>name</code> — сбросить последнее уведомление для канала\n"
         "/resetall — сбросить последнее уведомление для всех каналов\n"
+        "/digest <code>minutes</code> | <code>off</code> — собирать новые посты в один дайджест\n"
         "/debug — техническая информация\n"
         "/help — помощь"
     )
@@ -226,7 +1914,15 @@ async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = f"⚙️ <b>Debug Info</b>\n"
     text += f"Server Time: {human_date_from_ts(now_ts)}\n"
     text += f"User ID: <code>{user_id}</code>\n"
-    text += f"Total Subs: {len(subs)}\n\n"
+    text += f"Total Subs: {len(subs)}\n"
+    if update_queues:
+        text += (f"Webhook Queue: {update_queue_size()}/{WEBHOOK_QUEUE_SIZE}, "
+                 f"accepted {webhook_stats['accepted']}, rejected {webhook_stats['rejected']}, "
+                 f"failed {webhook_stats['failed']}\n")
+    text += (f"Subs Cache: {len(subs_cache)} users, hits {subs_cache_stats['hits']}, "
+             f"misses {subs_cache_stats['misses']}\n")
+    text += (f"Post Cache: hits {cache_stats['hits']}, redis {cache_stats['redis_hits']}, "
+             f"misses {cache_stats['misses']}, coalesced {cache_stats['coalesced']}\n\n")
 
     for ch, cfg in subs.items():
         text += f"<b>{ch}</b>:\n"
@@ -246,16 +1942,17 @@ async def reset_all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("У тебя нет подписок для сброса.")
         return
 
-    for channel in subs:
-        subs[channel]["last_sent"] = None
-
-    await db_save_user_subs(user_id, subs)
+    await db_update_subs(user_id, {channel: {"last_sent": None} for channel in subs})
     await update.message.reply_text(
         "♻️ <b>Все счетчики сброшены!</b>\nПри следующей проверке планировщик пришлет уведомления о последних постах по всем каналам.",
         parse_mode="HTML"
     )
 
 
+def check_all_lines(statuses: dict) -> str:
+    return "\n".join(f"• {channel}: {status}" for channel, status in statuses.items())
+
+
 async def check_all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     subs = await db_get_user_subs(user_id)
@@ -266,26 +1963,58 @@ async def check_all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     msg = await update.message.reply_text("🔄 Начинаю полную проверку всех каналов...")
 
-    changed = False
-    results = []
-    for channel in subs.keys():
-        is_new = await check_and_notify(user_id, channel, subs)
-        status = "✅ Есть новый пост!" if is_new else "😴 Изменений нет"
-        results.append(f"• {channel}: {status}")
-        if is_new: changed = True
+    sem = asyncio.Semaphore(CHECKALL_CONCURRENCY)
 
-    if changed:
-        await db_save_user_subs(user_id, subs)
+    async def check_one(channel):
+        async with sem:
+            try:
+                return channel, await check_and_notify(user_id, channel, subs)
+            except Exception as e:
+                print(f"Ошибка проверки {channel}: {e}")
+                return channel, None
+
+    statuses = {ch: "⏳ Проверяю..." for ch in subs}
+    done = 0
+    next_edit = time.monotonic() + CHECKALL_EDIT_INTERVAL
+    with fetch_priority("interactive", user_id):
+        tasks = [asyncio.create_task(check_one(ch)) for ch in subs]
+    for next_result in asyncio.as_completed(tasks):
+        channel, is_new = await next_result
+        done += 1
+        if is_new is None:
+            statuses[channel] = "⚠️ Ошибка проверки"
+        else:
+            statuses[channel] = "✅ Есть новый пост!" if is_new else "😴 Изменений нет"
 
-    await msg.edit_text("<b>Результаты проверки:</b>\n\n" + "\n".join(results), parse_mode="HTML")
+        # Редактируем сообщение не чаще CHECKALL_EDIT_INTERVAL, чтобы не упереться в лимиты Telegram
+        if done < len(subs) and time.monotonic() >= next_edit:
+            next_edit = time.monotonic() + CHECKALL_EDIT_INTERVAL
+            try:
+                await msg.edit_text(f"🔄 Проверено {done} из {len(subs)}:\n\n" + check_all_lines(statuses),
+                                    parse_mode="HTML")
+            except RetryAfter as e:
+                # Промежуточный прогресс не важен: следующее обновление — после паузы
+                next_edit = time.monotonic() + e.retry_after
+            except TelegramError as e:
+                print(f"Не удалось обновить прогресс /checkall: {e}")
+
+    text = "<b>Результаты проверки:</b>\n\n" + check_all_lines(statuses)
+    try:
+        await msg.edit_text(text, parse_mode="HTML")
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        await msg.edit_text(text, parse_mode="HTML")
+    except TelegramError:
+        # Сообщение с прогрессом недоступно — присылаем итог отдельным
+        await update.message.reply_text(text, parse_mode="HTML")
 
     return
 
 
 async def check_func(update_text, user_id, subs, channel=""):
     await update_text(f"⏳ Проверяю <b>{channel}</b>...", parse_mode="HTML")
-    is_new = await check_and_notify(user_id, channel, subs)
-    await db_save_user_subs(user_id, subs)
+    with fetch_priority("interactive", user_id):
+        is_new = await check_and_notify(user_id, channel, subs)
     if not is_new:
         await update_text(f"😴 На канале <b>{channel}</b> новых постов нет.", parse_mode="HTML")
 
@@ -315,8 +2044,7 @@ async def check_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def reset_func(update_text, user_id, subs, channel=""):
-    subs[channel]["last_sent"] = None
-    await db_save_user_subs(user_id, subs)
+    await db_update_sub(user_id, channel, last_sent=None)
     await update_text(f"♻️ Память для <b>{channel}</b> сброшена.", parse_mode="HTML")
 
 
@@ -357,8 +2085,7 @@ async def set_interval_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             hours = int(context.args[1])
             if channel in subs:
-                subs[channel]["interval"] = hours
-                await db_save_user_subs(user_id, subs)
+                await db_update_sub(user_id, channel, interval=hours)
                 await update.message.reply_text(f"⏱ Интервал для {channel}: {hours} ч.")
                 return
         except ValueError:
@@ -372,6 +2099,38 @@ async def set_interval_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return
 
 
+async def digest_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/digest N — собирать новые посты N минут в одно сообщение, /digest off — выключить"""
+    user_id = str(update.effective_user.id)
+
+    if not context.args:
+        minutes = await redis_client.hget("digest_windows", user_id)
+        state = f"раз в {minutes} мин." if minutes else "выключен"
+        await update.message.reply_text(
+            f"📬 Дайджест: {state}\n\n"
+            "/digest <code>минуты</code> — присылать новые посты одним сообщением\n"
+            "/digest <code>off</code> — присылать каждый пост сразу",
+            parse_mode="HTML"
+        )
+        return
+
+    arg = context.args[0].strip().lower()
+    if arg in ("off", "0"):
+        await redis_client.hdel("digest_windows", user_id)
+        await update.message.reply_text("✅ Дайджест выключен, посты будут приходить сразу.")
+        return
+
+    try:
+        minutes = max(int(arg), 1)
+    except ValueError:
+        await update.message.reply_text("⚠️ Используй: /digest <минуты> или /digest off")
+        return
+
+    await redis_client.hset("digest_windows", user_id, minutes)
+    m_text = plural(minutes, "минуту", "минуты", "минут")
+    await update.message.reply_text(f"✅ Новые посты будут собираться в дайджест за {minutes} {m_text}.")
+
+
 # ---------------- UPDATED BUTTON HANDLER ----------------
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -389,8 +2148,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if action == "unsub_pick":
         if channel in subs:
-            del subs[channel]
-            await db_save_user_subs(user_id, subs)
+            await db_delete_sub(user_id, channel)
             await query.edit_message_text(f"✅ Подписка на <b>{channel}</b> удалена.", parse_mode="HTML")
         else:
             await query.edit_message_text("Ошибка: подписка уже была удалена ранее.")
@@ -422,8 +2180,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         subs = await db_get_user_subs(user_id)
         if channel in subs:
-            subs[channel]["interval"] = hours
-            await db_save_user_subs(user_id, subs)
+            await db_update_sub(user_id, channel, interval=hours)
             del context.user_data["awaiting_interval_for"]
 
             h_text = plural(hours, "час", "часа", "часов")
@@ -447,6 +2204,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/checkall — проверить все подписки сейчас\n"
         "/reset <канал> — сбросить last_sent для канала\n"
         "/resetall — сбросить last_sent для всех каналов\n"
+        "/digest <минуты> | off — дайджест вместо отдельных уведомлений\n"
         "/debug — режим отладки\n"
         "/help — помощь"
     )
@@ -461,8 +2219,12 @@ async def subscribe_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
 
     await update.message.reply_text(f"🔍 Проверяю канал {channel}...")
-    post = await get_last_post_info(channel)
+    with fetch_priority("subscribe", user_id):
+        post = await get_last_post_cached(channel)
 
+    if post is CIRCUIT_OPEN:
+        await update.message.reply_text("⏳ Boosty сейчас недоступен, попробуй подписаться чуть позже.")
+        return
     if not post:
         await update.message.reply_text("❌ Канал не найден или нет постов.")
         return
@@ -477,7 +2239,7 @@ async def subscribe_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "last_sent": post["timestamp"],
         "last_check": int(time.time())
     }
-    await db_save_user_subs(user_id, subs)
+    await db_save_sub(user_id, channel, subs[channel])
     await update.message.reply_text(f"🎉 Успешно! Последний пост был {human_date_from_ts(post['timestamp'])}.")
 
 
@@ -493,8 +2255,7 @@ async def unsubscribe_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if context.args:
         channel = context.args[0].strip().lower()
         if channel in subs:
-            del subs[channel]
-            await db_save_user_subs(user_id, subs)
+            await db_delete_sub(user_id, channel)
             await update.message.reply_text(f"✅ Ты успешно отписался от <b>{channel}</b>.", parse_mode="HTML")
         else:
             await update.message.reply_text(f"❌ Ты не подписан на канал {channel}.")
@@ -534,27 +2295,87 @@ async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------------- WEBHOOK & LIFESPAN ----------------
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    global telegram_app, redis_client
-    redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+def update_queue_size() -> int:
+    return sum(q.qsize() for q in update_queues)
+
 
-    telegram_app = ApplicationBuilder().token(TG_TOKEN).build()
+def update_shard(update: Update) -> asyncio.Queue:
+    """Очередь для апдейта. Шардируем по пользователю (иначе по чату): его апдейты
+    обрабатываются по порядку одним обработчиком, без гонок за context.user_data
+    (например, ввод интервала после кнопки)"""
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return update_queues[key % len(update_queues)]
+
+
+async def update_worker(queue: asyncio.Queue):
+    """Фоновый обработчик апдейтов, принятых вебхуком; разбирает свою очередь по порядку"""
+    while True:
+        update = await queue.get()
+        try:
+            await telegram_app.process_update(update)
+            webhook_stats["processed"] += 1
+        except Exception as e:
+            webhook_stats["failed"] += 1
+            print(f"Ошибка обработки апдейта: {e}")
+        finally:
+            queue.task_done()
+
+
+def register_redis_scripts():
+    """Регистрирует Lua-скрипты на текущем redis_client"""
+    global migrate_user_script, claim_notification_script, renew_lease_script, release_lease_script
+    global fan_out_script, update_sub_script, take_digest_script, claim_due_script, release_claims_script
+    migrate_user_script = redis_client.register_script(MIGRATE_USER_LUA)
+    claim_notification_script = redis_client.register_script(CLAIM_NOTIFICATION_LUA)
+    renew_lease_script = redis_client.register_script(RENEW_LEASE_LUA)
+    release_lease_script = redis_client.register_script(RELEASE_LEASE_LUA)
+    fan_out_script = redis_client.register_script(FAN_OUT_LUA)
+    update_sub_script = redis_client.register_script(UPDATE_SUB_LUA)
+    take_digest_script = redis_client.register_script(TAKE_DIGEST_LUA)
+    claim_due_script = redis_client.register_script(CLAIM_DUE_LUA)
+    release_claims_script = redis_client.register_script(RELEASE_CLAIMS_LUA)
+
+
+def build_telegram_app():
+    """Создает приложение бота и регистрирует обработчики"""
+    builder = ApplicationBuilder().token(TG_TOKEN)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
 
     # Регистрация
-    telegram_app.add_handler(CommandHandler("start", start_cmd))
-    telegram_app.add_handler(CommandHandler("subscribe", subscribe_cmd))
-    telegram_app.add_handler(CommandHandler("unsubscribe", unsubscribe_cmd))
-    telegram_app.add_handler(CommandHandler("list", list_cmd))
-    telegram_app.add_handler(CommandHandler("help", help_cmd))
-    telegram_app.add_handler(CommandHandler("debug", debug_cmd))
-    telegram_app.add_handler(CommandHandler("check", check_cmd))
-    telegram_app.add_handler(CommandHandler("checkall", check_all_cmd))
-    telegram_app.add_handler(CommandHandler("reset", reset_cmd))
-    telegram_app.add_handler(CommandHandler("resetall", reset_all_cmd))
-    telegram_app.add_handler(CommandHandler("setinterval", set_interval_cmd))
-    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-    telegram_app.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CommandHandler("start", start_cmd))
+    application.add_handler(CommandHandler("subscribe", subscribe_cmd))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe_cmd))
+    application.add_handler(CommandHandler("list", list_cmd))
+    application.add_handler(CommandHandler("help", help_cmd))
+    application.add_handler(CommandHandler("debug", debug_cmd))
+    application.add_handler(CommandHandler("check", check_cmd))
+    application.add_handler(CommandHandler("checkall", check_all_cmd))
+    application.add_handler(CommandHandler("reset", reset_cmd))
+    application.add_handler(CommandHandler("resetall", reset_all_cmd))
+    application.add_handler(CommandHandler("setinterval", set_interval_cmd))
+    application.add_handler(CommandHandler("digest", digest_cmd))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    return application
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global telegram_app, redis_client, http_client, parse_pool, update_queues
+    redis_client = TimedRedis.from_url(REDIS_URL, decode_responses=True)
+    register_redis_scripts()
+    http_client = create_http_client()
+    if PARSE_PROCESSES > 0:
+        parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES)
+
+    telegram_app = build_telegram_app()
 
     await telegram_app.initialize()
     await setup_commands(telegram_app)
@@ -563,7 +2384,7 @@ async def lifespan(app: FastAPI):
     # Webhook Logic (Local + Prod)
     webhook_url = WEBHOOK_URL
     if not webhook_url:
-        ngrok_url = get_ngrok_url()
+        ngrok_url = await get_ngrok_url()
         if ngrok_url:
             webhook_url = f"{ngrok_url}/webhook/{TG_TOKEN}"
             print(f"🚀 Локальный Webhook через ngrok: {webhook_url}")
@@ -572,15 +2393,50 @@ async def lifespan(app: FastAPI):
         await telegram_app.bot.set_webhook(url=webhook_url)
 
     stop_event = asyncio.Event()
+    # Аренды отпускаем только после остановки планировщика, чтобы шарды не перехватили посреди цикла
+    lease_stop = asyncio.Event()
     st_task = asyncio.create_task(scheduler_loop(stop_event))
+    lease_task = asyncio.create_task(lease_loop(lease_stop))
+    digest_task = asyncio.create_task(digest_loop(stop_event))
+    invalidation_task = asyncio.create_task(subs_invalidation_loop(stop_event))
+    notify_tasks = [asyncio.create_task(delivery_worker(stop_event)) for _ in range(NOTIFY_WORKERS)]
+    update_tasks = []
+    if WEBHOOK_ASYNC:
+        shard_size = max(1, WEBHOOK_QUEUE_SIZE // WEBHOOK_WORKERS)
+        update_queues = [asyncio.Queue(maxsize=shard_size) for _ in range(WEBHOOK_WORKERS)]
+        update_tasks = [asyncio.create_task(update_worker(q)) for q in update_queues]
 
     yield
 
+    # Дообрабатываем уже принятые апдейты
+    if update_queues:
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in update_queues)), timeout=10)
+        except asyncio.TimeoutError:
+            print(f"Не обработано апдейтов при остановке: {update_queue_size()}")
+    for t in update_tasks:
+        t.cancel()
     stop_event.set()
-    await st_task
+    try:
+        await asyncio.wait_for(st_task, timeout=SCHEDULER_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"Планировщик не остановился за {SCHEDULER_SHUTDOWN_TIMEOUT} с, цикл прерван")
+    lease_stop.set()
+    await lease_task
+    await digest_task
+    await invalidation_task
+    try:
+        await asyncio.wait_for(asyncio.gather(*notify_tasks), timeout=NOTIFY_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Взятые задания вернутся в очередь по истечении NOTIFY_VISIBILITY
+        print(f"Отправители не остановились за {NOTIFY_SHUTDOWN_TIMEOUT} с")
+    await cancel_post_fetches()
     await telegram_app.stop()
     await telegram_app.shutdown()
     await redis_client.close()
+    await http_client.aclose()
+    if parse_pool:
+        parse_pool.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -592,11 +2448,32 @@ async def root():
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Метрики в формате Prometheus. Приложение публичное (на нем же вебхук), поэтому
+    отдаем их только с METRICS_TOKEN"""
+    auth = request.headers.get("authorization", "")
+    if not METRICS_TOKEN or not secrets.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return JSONResponse({"ok": False}, status_code=404)
+    await refresh_queue_metrics()
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/webhook/{token}")
 async def webhook(token: str, request: Request):
     if token == TG_TOKEN:
         update = Update.de_json(await request.json(), telegram_app.bot)
-        await telegram_app.process_update(update)
+        if not update_queues:
+            await telegram_app.process_update(update)
+            return {"ok": True}
+
+        # Очередь переполнена — отвечаем 503, Telegram повторит доставку позже
+        try:
+            update_shard(update).put_nowait(update)
+        except asyncio.QueueFull:
+            webhook_stats["rejected"] += 1
+            return JSONResponse({"ok": False}, status_code=503)
+        webhook_stats["accepted"] += 1
     return {"ok": True}
 
 